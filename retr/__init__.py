@@ -9,3 +9,7 @@ class ValidateException(Exception):
 class ProxyException(Exception):
 # Used in the filter proxy engine. Argument: proxy
     pass
+
+class BodyTooLargeException(Exception):
+# Raised by stream() when the response body is over max_size. Argument: url
+    pass
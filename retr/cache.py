@@ -0,0 +1,247 @@
+'''Page caches for retriever.cached(). Set the cache member of the retriever to
+one of them, the file name passed to cached() becomes the key.
+
+dircache keeps every page in its own file named by the key, like cached() always
+did. sqlcache keeps them compressed in one SQLite file by the hash of the key,
+with optional time to live and size limit.
+
+retriever_async runs them through aiocache, so the disk I/O is off the event
+loop.
+'''
+
+from os import makedirs, path, replace, stat, fsync, O_RDONLY, \
+    open as os_open, close as os_close
+from time import time
+from hashlib import sha1
+from threading import Lock
+from logging import getLogger
+from concurrent.futures import ThreadPoolExecutor
+from asyncio import Queue, ensure_future, get_running_loop, CancelledError
+from contextlib import suppress
+import sqlite3
+import zlib
+
+try:
+    import zstandard
+except ImportError: # Optional, zlib is used without it
+    zstandard=None
+
+lg=getLogger(__name__)
+
+class pagecache:
+    '''The interface of the caches, keys are str, data is bytes'''
+    def get(self, key):
+        '''Returns the data or None if it's not there (or expired)'''
+        raise NotImplementedError
+
+    def put(self, key, data):
+        raise NotImplementedError
+
+    def put_many(self, items):
+        '''Puts (key, data) pairs and makes them durable'''
+        for key, data in items: self.put(key, data)
+        self.flush()
+
+    def flush(self):
+        '''Makes the puts so far durable'''
+        pass
+
+    def close(self):
+        self.flush()
+
+class dircache(pagecache):
+    '''Every page in its own file named by the key. ttl in seconds makes older
+files count as missing. put() leaves syncing to the OS, put_many() syncs the
+files it has written.'''
+    def __init__(self, ttl=None):
+        self.ttl=ttl
+
+    def get(self, key):
+        try:
+            if self.ttl and stat(key).st_mtime < time()-self.ttl: return None
+            with open(key, 'rb') as ff: return ff.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, data):
+        # Only create intermediate dirs when we write
+        makedirs(path.dirname(key), exist_ok=True)
+        with open(key+'.part', 'wb') as ff: ff.write(data)
+        replace(key+'.part', key)
+
+    def put_many(self, items):
+        keys=[]
+        for key, data in items:
+            self.put(key, data)
+            keys.append(key)
+        for key in keys:
+            try:
+                with open(key, 'rb') as ff: fsync(ff.fileno())
+            except FileNotFoundError: # Replaced or removed meanwhile
+                pass
+        # The renames are durable when the directories are synced
+        for d in {path.dirname(key) for key in keys}:
+            fd=os_open(d or '.', O_RDONLY)
+            try:
+                fsync(fd)
+            finally:
+                os_close(fd)
+
+class sqlcache(pagecache):
+    '''Pages in one SQLite file fn, by sha1 of the key, compressed with zstd (if
+zstandard is installed) or zlib. Thread-safe.
+
+ttl: pages older than that many seconds count as missing.
+max_size: the total of compressed pages in bytes, the oldest are deleted over it.
+batch: the puts are committed by that many at a time, call flush() or close()
+in the end.'''
+    def __init__(self, fn, ttl=None, max_size=None, batch=100, level=3):
+        self.ttl=ttl
+        self.max_size=max_size
+        self.batch=batch
+        if zstandard:
+            self.codec='zstd'
+            self.compressor=zstandard.ZstdCompressor(level=level)
+            self.decompressor=zstandard.ZstdDecompressor()
+        else:
+            self.codec='zlib'
+        self.lock=Lock()
+        self.pending={} # Puts not committed yet, by hashed key
+        self.db=sqlite3.connect(fn, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS pages (
+            key BLOB PRIMARY KEY, stamp REAL, codec TEXT, size INTEGER,
+            data BLOB)''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS pages_stamp ON pages(stamp)')
+        self.size=self.db.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM pages').fetchone()[0]
+
+    def compress(self, data):
+        if self.codec == 'zstd': return self.compressor.compress(data)
+        return zlib.compress(data)
+
+    def decompress(self, codec, data):
+        if codec == 'zstd':
+            if not zstandard:
+                raise ValueError('zstandard is needed to read this cache')
+            return self.decompressor.decompress(data)
+        return zlib.decompress(data)
+
+    def get(self, key):
+        h=sha1(key.encode()).digest()
+        with self.lock:
+            if h in self.pending:
+                stamp, codec, data=self.pending[h]
+            else:
+                row=self.db.execute('SELECT stamp, codec, data FROM pages '
+                                    'WHERE key=?', (h,)).fetchone()
+                if not row: return None
+                stamp, codec, data=row
+        if self.ttl and stamp < time()-self.ttl: return None
+        return self.decompress(codec, data)
+
+    def put(self, key, data):
+        h=sha1(key.encode()).digest()
+        data=self.compress(data)
+        with self.lock:
+            self.pending[h]=(time(), self.codec, data)
+            if len(self.pending) >= self.batch: self._flush()
+
+    def flush(self):
+        with self.lock: self._flush()
+
+    def _flush(self):
+        '''Commits the pending puts and evicts the oldest pages if needed. The lock
+must be held.'''
+        if not self.pending: return
+        pending, self.pending=self.pending, {}
+        with self.db:
+            for h, (stamp, codec, data) in pending.items():
+                old=self.db.execute('SELECT size FROM pages WHERE key=?',
+                                    (h,)).fetchone()
+                if old: self.size-=old[0]
+                self.db.execute('INSERT OR REPLACE INTO pages VALUES '
+                                '(?, ?, ?, ?, ?)',
+                                (h, stamp, codec, len(data), data))
+                self.size+=len(data)
+            if self.ttl:
+                cutoff=time()-self.ttl
+                expired=self.db.execute(
+                    'SELECT COALESCE(SUM(size), 0) FROM pages WHERE stamp < ?',
+                    (cutoff,)).fetchone()[0]
+                if expired:
+                    self.db.execute('DELETE FROM pages WHERE stamp < ?',
+                                    (cutoff,))
+                    self.size-=expired
+            while self.max_size and self.size > self.max_size:
+                rows=self.db.execute('SELECT key, size FROM pages '
+                                     'ORDER BY stamp LIMIT 100').fetchall()
+                if not rows: break
+                for h, size in rows:
+                    self.db.execute('DELETE FROM pages WHERE key=?', (h,))
+                    self.size-=size
+                    if self.size <= self.max_size: break
+        lg.debug('Cache committed {}, size {}'.format(len(pending), self.size))
+
+    def close(self):
+        with self.lock:
+            self._flush()
+            self.db.close()
+
+class aiocache:
+    '''Async front of a pagecache, the event loop never waits for the disk. Gets
+are run in a thread pool of workers, puts are queued (up to queue_size) to a
+writer task, which hands them to put_many() of the cache by batch at a time, so
+they're made durable per batch. The pages queued are found by get() meanwhile.'''
+    def __init__(self, cache, workers=4, batch=100, queue_size=1000):
+        self.cache=cache
+        self.batch=batch
+        self.queue_size=queue_size
+        self.executor=ThreadPoolExecutor(workers)
+        self.pending={} # Data by key, not written yet
+        self.queue=None # Created in the loop, with the writer
+        self.writer=None
+
+    async def get(self, key):
+        if key in self.pending: return self.pending[key]
+        return await get_running_loop().run_in_executor(
+            self.executor, self.cache.get, key)
+
+    async def put(self, key, data):
+        if not self.writer:
+            self.queue=Queue(self.queue_size)
+            self.writer=ensure_future(self.write())
+        self.pending[key]=data
+        await self.queue.put((key, data))
+
+    async def write(self):
+        '''The writer task'''
+        while True:
+            items=[await self.queue.get()]
+            while len(items) < self.batch and not self.queue.empty():
+                items.append(self.queue.get_nowait())
+            try:
+                await get_running_loop().run_in_executor(
+                    self.executor, self.cache.put_many, items)
+            except CancelledError:
+                raise
+            except Exception:
+                lg.exception('Cache write of {} pages'.format(len(items)))
+            finally:
+                for key, data in items:
+                    if self.pending.get(key) is data: del self.pending[key]
+                    self.queue.task_done()
+
+    async def flush(self):
+        '''Waits for the queued puts to be written'''
+        if self.queue: await self.queue.join()
+
+    async def close(self):
+        '''Writes the queued puts and stops the writer. The cache itself is left
+open.'''
+        await self.flush()
+        if self.writer:
+            self.writer.cancel()
+            with suppress(CancelledError): await self.writer
+            self.writer=None
+        self.executor.shutdown()
@@ -0,0 +1,118 @@
+'''Adaptive concurrency for the farms.
+
+f=farm(100, init, it, controller=aimd())
+
+The farm starts with the threads (or tasks) it was given, but only limit of
+them take items at a time. The retrievers report every request to
+f.controller, and each interval the controller looks at what it got: if the
+error rate or the mean latency are over the targets, or proxies were told to
+chill out, the limit is cut by decrease, otherwise it grows by increase
+(additive increase, multiplicative decrease). Until the first cut it doubles
+instead (slow start), in case it was started low. metrics() shows the decisions.
+'''
+
+from threading import Lock
+from collections import deque
+from time import time
+from logging import getLogger
+
+lg=getLogger(__name__)
+
+class aimd:
+    '''Thread-safe, the farms and retrievers of both kinds use it the same way'''
+    def __init__(self, minimum=1, maximum=None, initial=None, increase=1,
+                 decrease=.5, interval=5, error_rate=.2, latency=None,
+                 history=100):
+        '''maximum: the size of the farm (see bind()) or less
+initial: where the limit starts, the maximum by default
+latency: the target mean latency in seconds, not checked if None
+error_rate: the share of the failed requests tolerated in an interval
+history: how many last decisions metrics() shows'''
+        self.minimum=minimum
+        self.maximum=maximum
+        self.initial=initial
+        self.limit=initial or maximum or minimum
+        self.slow_start=True # Doubling the limit until the first cut
+        self.listeners=[] # Called when the limit grows
+        self.increase=increase
+        self.decrease=decrease
+        self.interval=interval
+        self.error_rate=error_rate
+        self.latency=latency
+        self.lock=Lock()
+        self.stamp=time() # Start of the interval
+        self.reset()
+        self.increases=0
+        self.decreases=0
+        self.history=deque(maxlen=history) # (time, limit, reason)
+
+    def bind(self, size):
+        '''Called by the farm with the number of its threads or tasks: the limit
+can't go over it'''
+        with self.lock:
+            self.maximum=min(self.maximum, size) if self.maximum else size
+            if self.initial is None: self.limit=self.maximum
+            self.limit=max(self.minimum, min(self.limit, self.maximum))
+
+    def reset(self):
+        '''Counters of the interval, the lock must be held'''
+        self.requests=0
+        self.errors=0
+        self.chills=0
+        self.total_latency=0.
+
+    def report(self, latency=None, ok=True, chilled=False):
+        '''Called by the retrievers for each request'''
+        with self.lock:
+            self.requests+=1
+            if not ok: self.errors+=1
+            if chilled: self.chills+=1
+            if latency is not None: self.total_latency+=latency
+            old=self.limit
+            grown=self.update() > old
+        if grown: # Let the waiting threads or tasks in
+            for fn in list(self.listeners): fn()
+
+    def update(self, now=None):
+        '''Changes the limit when the interval is over, the lock must be held.
+Returns the limit.'''
+        now=now or time()
+        if now-self.stamp < self.interval: return self.limit
+        self.stamp=now
+        if not self.requests: return self.limit # Nothing to judge by
+
+        ok=self.requests-self.errors
+        rate=self.errors/self.requests
+        mean=self.total_latency/ok if ok else None
+        if self.chills:
+            reason='{} chills'.format(self.chills)
+        elif rate > self.error_rate:
+            reason='error rate {:.2f}'.format(rate)
+        elif self.latency and mean and mean > self.latency:
+            reason='latency {:.2f}s'.format(mean)
+        else:
+            reason=None
+
+        old=self.limit
+        if reason:
+            self.limit=max(self.minimum, int(self.limit*self.decrease))
+            self.decreases+=1
+            self.slow_start=False
+        else:
+            limit=self.limit*2 if self.slow_start else self.limit+self.increase
+            if self.maximum: limit=min(self.maximum, limit)
+            self.limit=limit
+            if self.limit != old: self.increases+=1
+            reason='ok'
+        if self.limit != old:
+            lg.info('Concurrency {} -> {}: {}'.format(old, self.limit, reason))
+            self.history.append((now, self.limit, reason))
+        self.reset()
+        return self.limit
+
+    def metrics(self):
+        with self.lock:
+            return {'limit': self.limit, 'increases': self.increases,
+                    'decreases': self.decreases,
+                    'requests': self.requests, 'errors': self.errors,
+                    'chills': self.chills, 'history': list(self.history)}
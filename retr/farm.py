@@ -13,47 +13,76 @@ Where letter is extending retriever, and all_letters is an iterable to run do()
 f.run() picks results yield-ed in do().
 '''
 
-from threading import Condition, Thread, Barrier, BrokenBarrierError
+from threading import Condition, Thread, Barrier, BrokenBarrierError, Lock
 import gc
 from os import _exit
 from logging import getLogger
-from queue import Queue, Empty # Exception
+from queue import Queue, Empty, Full # Exceptions
 from types import GeneratorType
-from itertools import repeat, chain
+from itertools import repeat, chain, islice
+from collections import deque
 from contextlib import suppress
-from time import sleep
+from time import sleep, perf_counter, time
+
+from .schedule import scheduled, itemqueue, inf
 
 lg=getLogger(__name__)
 
+class item_done:
+    '''Put to the queue after the results of the item, run() marks it done in the journal when it gets there'''
+    __slots__=('item',)
+
+    def __init__(self, item):
+        self.item=item
+
 # from pympler.tracker import SummaryTracker
 # from pympler import asizeof
 
 class farm:
     '''init returns an object, we'll call o.run(i), then del o in the end.'''
     def __init__(self, num_threads, init, it, extendable=False, tn_tmpl=None,
-                 reuse=None, handler=None):
+                 reuse=None, handler=None, queue_size=0, drop=False,
+                 chunk=16, journal=None, extend_priority=-1, controller=None):
         '''When extendable is True, it means that we need to leave threads ready in case the input list is extended (with extend()). Also the run() function can be invoked several times. The drawback is that underneath the input it is converted to a list, and then manipulated, so it's feasible to start with relatively small input data. Don't forget to call close(), it will clean up all the threads. Or you can use it as a context manager, so this will be called automatically upon __exit__().
 If extendable is False, the code is simpler, but it supports iterables however big.
 tn_tmpl is format() template with {} to be changed to thread's number.
  reuse tells whether to stash worked sessions for future reuse. If it's a list, it's a global list of warm sessions.
-A function in the handler parameter is invoked each second, while the processing is postponed, so it shouldn't take long to complete'''
+A function in the handler parameter is invoked each second, while the processing is postponed, so it shouldn't take long to complete
+queue_size limits the results waiting to be picked by run(), 0 is no limit. When it's full the threads wait, or if drop is True, the results are dropped (and counted). See metrics().
+chunk is how many items a thread takes at once, but never more than its share of the items left. If the number of the items is not known (it has no len() and the farm is not extendable), they're taken one by one.
+journal is a retr.journal.journal to record the items started and done in, the items done there already are skipped. An item is done when its do() has finished without an exception and run() has handed out all its results.
+The items can be wrapped in retr.schedule.scheduled() to give them a priority (lower goes first) and a deadline (time(), they're dropped past it, see metrics()). Only the extendable farm orders them, the other one takes the input as it goes. extend_priority is the default priority of the items added with extend(), the input ones have 0.
+controller, say retr.controller.aimd, sets how many of the threads process the items at a time, the retrievers report to it.'''
         self.waiting=0
         self.extendable=extendable
+        self.cancelled=False
 
+        total=None
+        with suppress(TypeError): total=len(it)
         if self.extendable:
-            self.arr=list(it) # If it was a generator for example. Make it real.
+            self.arr=itemqueue(it) # If it was a generator for example. Make it real.
             lg.info("Total: {}".format(len(self.arr)))
         else: # Otherwise leave it as it is, we'll treat it as iterator
             self.arr=iter(it)
             
         self.cond=Condition()
-        self.num_threads=num_threads if num_threads else len(self.arr)
+        self.num_threads=num_threads if num_threads else total
+        self.chunk=chunk
+        self.left=None if self.extendable else total # Items left in the input
         # Barrier to wait on for the restart (when extendable)
         self.barr=Barrier(self.num_threads+1)
         self.init=init
         self.tn_tmpl=tn_tmpl
         self.reuse=reuse
         self.handler=handler
+        self.journal=journal
+        self.extend_priority=extend_priority
+        self.controller=controller
+        self.slots=Condition() # For the threads waiting for the controller
+        self.running=0 # Threads processing the items
+        if controller:
+            controller.bind(self.num_threads)
+            controller.listeners.append(self.release_all)
         # Objects living within threads, used to signal them to quit
         # (by setting quit_flag)
         self.objects=[]
@@ -63,7 +92,14 @@ A function in the handler parameter is invoked each second, while the processing
             self.reuse_pool=None
             #if self.reuse: self.reuse_pool=[]
         
-        self.q=Queue()
+        self.q=Queue(queue_size)
+        self.drop=drop
+        self.mlock=Lock() # For the counters below
+        self.produced=0 # Results put to the queue
+        self.dropped=0 # Results dropped because the queue was full
+        self.producer_wait=0. # Seconds the threads have waited for the queue
+        self.consumer_wait=0. # Seconds run() has waited for the results
+        self.expired=0 # Items dropped past their deadline, without extendable
         
         self.tlist=[]
 
@@ -89,19 +125,16 @@ A function in the handler parameter is invoked each second, while the processing
     def __exit__(self, *exc):
         self.close()
 
-    def extend(self, arr, end=False):
-        '''If end is True, add to the end'''
+    def extend(self, arr, end=False, priority=None, deadline=None):
+        '''Adds the items with the priority, extend_priority by default, so they go before the ones from the input. If end is True, they're queued after the input (priority 0). The items can be scheduled() too.'''
         if not self.extendable:
             lg.error('The farm is not extendable, "extendable" parameter is False')
             return
-        
+
+        if priority is None: priority=0 if end else self.extend_priority
         with self.cond:
             orig_len=len(self.arr)
-            #if type(arr) is GeneratorType: arr=tuple(arr)
-            if end or self.arr and self.arr[-1] is not None:
-                self.arr+=arr
-            else: # When we're quitting
-                self.arr[:0]=arr # Insert in the beginning, so poison pills won't get lost
+            for i in arr: self.arr.push(i, priority, deadline)
             lg.info("Total after extend: {}".format(len(self.arr)))
             #lg.info("Notifying: {}".format(len(self.arr)-orig_len))
             self.cond.notify( len(self.arr)-orig_len )
@@ -109,8 +142,37 @@ A function in the handler parameter is invoked each second, while the processing
     def print_arr(self):
         '''Will be printed on farm exit. Beware to call it while the threads are running if you need the actual list.'''
         with self.cond:
-            print(self.arr)
+            print(self.arr.items() if self.extendable else self.arr)
         
+    def put(self, res):
+        '''Puts the result for run() to pick, waiting while the queue is full, or dropping it if drop is set'''
+        if self.drop:
+            try:
+                self.q.put_nowait(res)
+            except Full:
+                with self.mlock: self.dropped+=1
+                return
+            waited=0.
+        else:
+            start=perf_counter()
+            self.q.put(res)
+            waited=perf_counter()-start
+        with self.mlock:
+            self.produced+=1
+            self.producer_wait+=waited
+
+    def metrics(self):
+        '''Queue depth and the counters of the results queue, the items expired and the concurrency'''
+        with self.mlock:
+            return {'depth': self.q.qsize(), 'maxsize': self.q.maxsize,
+                    'produced': self.produced, 'dropped': self.dropped,
+                    'producer_wait': self.producer_wait,
+                    'consumer_wait': self.consumer_wait,
+                    'expired': self.arr.expired if self.extendable
+                    else self.expired, 'running': self.running,
+                    'controller': self.controller.metrics()
+                    if self.controller else None}
+
     def reusing(self):
         return type(self.reuse_pool) is list
     
@@ -123,47 +185,99 @@ A function in the handler parameter is invoked each second, while the processing
             yield from o.do(i)
         #lg.debug('do: {}'.format(res))
         #return res
-        
+
+    def process(self, o, i):
+        '''Puts the results of the item, minding the journal'''
+        if self.journal:
+            if i in self.journal:
+                lg.debug('Done already: {}'.format(i))
+                return
+            self.journal.start(i)
+        if self.controller: self.acquire()
+        try:
+            for j in farm.handle_item(o, i): self.put(j)
+        finally:
+            if self.controller: self.release()
+        if self.journal: self.done(i)
+
+    def done(self, i):
+        '''The item is finished in the journal once run() has handed out its results'''
+        if not self.drop:
+            self.q.put(item_done(i))
+            return
+        try:
+            self.q.put_nowait(item_done(i))
+        except Full: # Its results are being dropped anyway
+            self.journal.finish(i)
+
+    def acquire(self):
+        '''Waits until the controller lets one more thread in'''
+        with self.slots:
+            while self.running >= self.controller.limit:
+                self.slots.wait() # release_all() when the limit grows
+            self.running+=1
+
+    def release(self):
+        with self.slots:
+            self.running-=1
+            self.slots.notify_all()
+
+    def release_all(self):
+        '''Wakes up the threads waiting for the controller, it has let more in'''
+        with self.slots: self.slots.notify_all()
+
+    def take(self, lm):
+        '''How many items a thread takes at once when lm are there: up to chunk, but no more than a fair share, so the threads are kept busy at the end'''
+        return max(1, min(self.chunk, lm//self.num_threads))
+
     def do_extendable(self):
-        '''We need to leave threads ready in case the array is extended. Otherwise we can quit right after do() has completed. Also we can use this farm several times, the objects remain live, so we can extend and invoke another run() to gather the results as many times as we want.'''
+        '''We need to leave threads ready in case the array is extended. Otherwise we can quit right after do() has completed. Also we can use this farm several times, the objects remain live, so we can extend and invoke another run() to gather the results as many times as we want.
+The items are taken from the top of the queue by chunks, so the threads meet on the condition less often.'''
         o=self.init()
         with suppress(AttributeError):
             if not o.f: o.f=self # Set to the current farm
         with self.cond: self.objects.append(o)
-            
+
+        buf=deque() # Entries taken by this thread
         while True:
-            self.cond.acquire()
-            
-            self.waiting+=1
-            lg.debug('waiting incremented: {}, len={}'.
-                     format(self.waiting,len(self.arr)))
-            if not len(self.arr):
-                if self.waiting == self.num_threads:
-                    # No threads left to replenish the array, we should all quit
-                    # Adding poison pills
-                    if 1:
+            if buf and (self.cancelled or self.preempted(buf[0])):
+                # Put them back, the poison pills or more urgent items (say,
+                # extended by do()) go before them anyway
+                with self.cond:
+                    for e in buf: self.arr.push_entry(e)
+                buf.clear()
+
+            if not buf:
+                self.cond.acquire()
+
+                self.waiting+=1
+                lg.debug('waiting incremented: {}, len={}'.
+                         format(self.waiting,len(self.arr)))
+                if not len(self.arr):
+                    if self.waiting == self.num_threads:
+                        # No threads left to replenish the array, we should
+                        # all quit. Put poison pills for everyone including us
                         lg.info('Killing all')
-                        # Put poison pills for everyone including us
-                        self.arr+=[None]*(self.num_threads)
-                        self.cond.notify(self.num_threads) # Wake up other threads
+                        self.pills(self.num_threads)
+                        self.cond.notify(self.num_threads) # Wake up others
                     else:
-                        lg.info('Killing all')
-                        self.arr+=[None]*(self.num_threads-1)
-                        self.cond.notify(self.num_threads-1)
-                        self.cond.release()
-                        break
-                else:
-                    self.cond.wait() # Someone else will kill us
-
-            lm=len(self.arr)
-            if lm: # Another check for those who have left cond.wait()
-                i=self.arr.pop()
-            self.waiting-=1
-            lg.debug('waiting decremented: '+str(self.waiting))
-            self.cond.release()
-            if not lm: continue # Someone has stolen our item, snap!
+                        self.cond.wait() # Someone else will kill us
 
+                lm=len(self.arr)
+                if lm: # Another check for those who have left cond.wait()
+                    buf.extend(self.arr.take(self.take(lm)))
+                self.waiting-=1
+                lg.debug('waiting decremented: '+str(self.waiting))
+                self.cond.release()
+                if not buf: continue # Someone has stolen our item, snap!
+
+            i=buf.popleft()[3]
             if i is None:
+                if buf: # Leave the rest to others, there may be their pills
+                    with self.cond:
+                        for e in buf: self.arr.push_entry(e)
+                        self.cond.notify(len(buf))
+                    buf.clear()
                 self.q.put(None) # Mark we're done
                 # Sleep on the condition to let other threads get their pills
                 lg.debug('Sleeping on barrier')
@@ -173,15 +287,26 @@ A function in the handler parameter is invoked each second, while the processing
                     break
                 lg.debug('Continuing after barrier')
                 continue # then restart processing the queue
-            for j in farm.handle_item(o, i): self.q.put(j)
+            self.process(o, i)
 
         with self.cond: self.objects.remove(o)
         del o
 
         lg.info("has finished")
 
+    def preempted(self, e):
+        '''Whether there's an entry to go before e in the queue'''
+        with suppress(IndexError): # The lock is not held, it could be emptied
+            return self.arr.heap[0] < e
+        return False
+
+    def pills(self, cnt):
+        '''Poison pills for the extendable threads, they go before any items. The lock must be held.'''
+        for _ in range(cnt): self.arr.push(None, -inf)
+
     def do(self):
-        '''if an item from the iterator is a tuple, we explode it to be arguments to do(). Otherwise we pass it verbatim'''
+        '''if an item from the iterator is a tuple, we explode it to be arguments to do(). Otherwise we pass it verbatim
+The items are taken from the iterator by chunks, so the threads meet on the condition less often.'''
         #tracker = SummaryTracker()
         
         o=None
@@ -194,16 +319,33 @@ A function in the handler parameter is invoked each second, while the processing
             if not o.f: o.f=self # Set to the current farm
         with self.cond: self.objects.append(o)
 
+        buf=deque() # Items taken by this thread
         #lg.warning(len(self.arr))
         while True:
-            with self.cond:
-                try:
-                    i=next(self.arr)
-                except StopIteration: # empty
-                    break                    
+            if not buf:
+                with self.cond:
+                    if self.left is None: # No telling how many are left
+                        buf.extend(islice(self.arr, 1))
+                    else:
+                        buf.extend(islice(self.arr, self.take(self.left)))
+                        self.left=max(self.left-len(buf), 0)
+                if not buf: break # empty
 
-            if i is None: break # End of queue marker
-            for j in farm.handle_item(o, i): self.q.put(j)
+            i=buf.popleft()
+            if i is None or self.cancelled:
+                if i is not None: buf.appendleft(i)
+                if buf: # Leave the rest to others, there may be their pills
+                    with self.cond:
+                        self.arr=chain(buf, self.arr)
+                        if self.left is not None: self.left+=len(buf)
+                break # End of queue marker
+            if isinstance(i, scheduled): # Only the deadline matters here
+                if i.deadline is not None and i.deadline < time():
+                    lg.warning('Past the deadline: {}'.format(i.item))
+                    with self.mlock: self.expired+=1
+                    continue
+                i=i.item
+            self.process(o, i)
 
         #lg.error(asizeof.asizeof(o))
         with self.cond:
@@ -224,8 +366,9 @@ A function in the handler parameter is invoked each second, while the processing
         if not cnt: cnt=self.num_threads # That many threads are running
 
         with self.cond:
+            self.cancelled=True # The threads leave the items they've taken
             if self.extendable:
-                self.arr+=[None]*cnt
+                self.pills(cnt)
             else:
                 self.arr=chain(repeat(None,cnt), self.arr)
             self.cond.notify( cnt )
@@ -234,6 +377,7 @@ A function in the handler parameter is invoked each second, while the processing
     def run(self):
         '''Main function to invoke. When KeyboardInterrupt is received, it sets the quit_flag in all the objects present, retrievers then raise an exception. It's the problem of the do() function to handle it and possibly extend the main list with the item that wasn't handled to show it in the end (for possible restart)
 self.handler() function is invoked each second if there are no items in the queue to allow for some rudimental auxiliary activity'''
+        self.cancelled=False
         # Now start the threads, only once
         if self.tlist:
             lg.debug('Restarting threads')
@@ -249,17 +393,24 @@ self.handler() function is invoked each second if there are no items in the queu
         cnt=self.num_threads # That many threads are running
 
         while True:
+            start=perf_counter()
             try:
                 res=self.q.get(timeout=1)
             except Empty:
+                with self.mlock: self.consumer_wait+=perf_counter()-start
                 if self.handler: self.handler()
                 continue # Go back to suck the queue
             except KeyboardInterrupt:
                 lg.warning( 'Trying to kill nicely, putting {} None'.format(cnt) )
                 self.cancel(cnt)
                 res=None
+            else:
+                with self.mlock: self.consumer_wait+=perf_counter()-start
                 
             #lg.warning('run: {}'.format(res))
+            if isinstance(res, item_done): # The consumer has had its results
+                self.journal.finish(res.item)
+                continue
             if res != None:
                 yield res
                 continue
@@ -2,222 +2,372 @@
 
 '''This module provides a class to run retrievers in several coroutines asynchronously.
 
+async def main():
+    f=farm(newark, 100)
+    async for res in f.run(urls): print(res)
+    print(f.remaining) # Items left unprocessed, if we were interrupted
+
+asyncio.run(main())
+
 See real world examples in the samples/.
 '''
 
-from asyncio import ensure_future, get_event_loop, wait, Queue, Task, Semaphore,\
-    CancelledError, InvalidStateError
-from os import _exit
+from asyncio import Queue, PriorityQueue, Event, Semaphore, CancelledError, \
+    create_task, current_task, gather, get_running_loop
+from inspect import getattr_static
+from concurrent.futures import ProcessPoolExecutor
+from collections import defaultdict, deque
+from urllib.parse import urlsplit
+from itertools import count
+from time import time
 from contextlib import suppress
 from logging import getLogger
 from pdb import set_trace
 
 from .utils import CustomAdapter
+from .retriever_async import shared_connector, has_connector, close_connector
+from .schedule import entry
 from . import ProxyException
-# from pympler.tracker import SummaryTracker
-# from pympler import asizeof
 
 lg=getLogger(__name__)
 lg=CustomAdapter(lg, {})
 
+finished=object() # Put to the results when all the items are done
+
+def host(i):
+    '''The default key for host_limit: the host of the URL, the item or its first element'''
+    if isinstance(i, (tuple, list)): i=i[0] if i else None
+    if isinstance(i, str): return urlsplit(i).hostname
+
 class farm:
-    '''init() returns an object o, we'll call o.run(i), then del o in the end.
+    '''init() returns an object o, we'll await o.do(i) for the items, then o.close() in the end.
 '''
 
-    def __init__(self, it, init, num_tasks=100, loop=None):
-        '''Initialise the data and start initial futures'''
-        self.num_objects=num_tasks # How many objects we can create
-        
-        self.loop=loop or get_event_loop()
-            
+    def __init__(self, init, num_tasks=100, connector={}, parse_workers=None,
+                 queue_size=None, journal=None, host_limit=None, limits={},
+                 key=host, extend_priority=-1, controller=None):
+        '''num_tasks: how many items are processed at a time, there's an object from init() for each
+queue_size: how many input items are taken ahead, twice num_tasks by default
+journal: a retr.journal.journal to record the items started and done in, the items done there already are skipped. An item is done when do() (and parse()) have finished without an exception.
+host_limit: how many items with the same key(item) (the host by default) are processed at a time, limits overrides it by key. The items over the limit are deferred, up to queue_size of them, while the others go on. Items with the key None are not limited.
+controller: say retr.controller.aimd, sets how many of the tasks process the items at a time, the retrievers report to it. See metrics().
+extend_priority: the default priority of the items added with extend(), the input ones have 0, lower goes first. The items can be wrapped in retr.schedule.scheduled() to set their priority and deadline (time(), they're dropped past it and counted in expired).
+connector: arguments for the TCPConnector shared by the retrievers, limit is num_tasks by default. The farm creates it if the loop has none and closes it in the end; one that's there already is left open, with its own arguments (there's a warning if they differ). The cache fronts of the retrievers are the farm's own, see retriever_async.cache_front().
+parse_workers: processes for the parse() stage, the number of CPUs by default; 0 to parse in the loop (for debugging). The stage is there if the class of the objects has a parse() staticmethod: the results of do() (unless None) are passed through it, and what it returns is the result. The task goes on to the next item meanwhile, up to num_tasks items are parsed at a time.'''
         self.init=init
-        self.objects=Queue(num_tasks, loop=loop) # Birth control device
-        self.args={} # Arguments by futures, they're redeemed on KeyboardInterrupt so we can restart the process at a later time
-
-        self.toget=Queue(loop=loop)
-        self.initial_toget=it
-        # The task that feeds the working queue
-        self.extender_task=ensure_future(self.extender())
-        self.args[self.extender_task]='extender'
-
-    async def _close(self):
-        #set_trace()
-        while not self.objects.empty():
-            o=await self.objects.get()
-            del o
-        
-    def close(self):
-        #task=ensure_future(self._close(self.loop))
-        res=self.loop.run_until_complete(self._close()) # task
-    # def __enter__(self):
-    #     return self
-    
-    # def __exit__(self, *exc):
-    #     self.close()
-
-    def done_task(self, future):
-        '''Default one, we don't care about results'''
-        # If only the current task (finished btw) has left
-        if len(Task.all_tasks()) == 1: self.loop.stop()
+        self.num_tasks=num_tasks
+        self.queue_size=queue_size or 2*num_tasks
+        self.connector_args=dict({'limit': num_tasks}, **connector)
+        self.connector=None # The shared connector if we've created it
+        self.fronts={} # aiocache fronts of the caches of our retrievers
+        self.parse_workers=parse_workers
+        self.executor=None # Created on the first parse
+        self.parsers={} # parse() staticmethod (or None) by class
+        self.parsing={} # Items being parsed by task
+        self.parse_slots=None # Created in run()
+        self.journal=journal
+        self.host_limit=host_limit
+        self.limits=limits
+        self.key=key
+        self.active=defaultdict(int) # Items being processed by key
+        self.deferred=defaultdict(deque) # Items over the limit by key
+        self.num_deferred=0
+        self.extend_priority=extend_priority
+        self.seq=count() # Keeps the order of the items with the same priority
+        self.expired=0
+        self.controller=controller
+        if controller: controller.bind(num_tasks)
+        self.running=0 # Tasks processing the items
+        self.slot=Event() # Set when a task is done with an item, or the limit grows
+        self.grown=None # Listener of the controller while run() goes
+
+        self.objects=[] # Created so far, closed in the end
+        self.tasks=set() # Our own tasks, only these are cancelled
+        self.args={} # Items being processed by the workers, they're redeemed on interrupt so we can restart the process at a later time
+        self.remaining=[] # Unprocessed items after an interrupted run()
+        self.toget=None # Created in run()
+        self.space=None # Set when an item is taken from toget
+        self.held=None # The input item waiting for space in toget
+        self.results=None
+
+    async def run(self, it=()):
+        '''Processes the items from it, and the ones extend() adds meanwhile, yielding the results of do() (or parse()) which are not None. it can be an iterator or an async iterator, it's taken lazily: no more than queue_size items are queued, so it may be huge. The results are queued up to num_tasks, so a slow consumer holds the workers up.
+
+If it's interrupted (cancelled, or the generator is closed), the items taken but not processed yet, or whose results were not taken, are left in self.remaining, the rest stay in it.'''
+        # Create the shared connector with our limits before the retrievers
+        # ask for it. If it's there, it's someone else's to close
+        if has_connector():
+            shared_connector(**self.connector_args)
+        else:
+            self.connector=shared_connector(**self.connector_args)
+
+        self.toget=PriorityQueue() # Entries (priority, deadline, seq, item)
+        self.space=Event()
+        self.results=Queue(self.num_tasks)
+        self.parse_slots=Semaphore(self.num_tasks)
+        self.remaining=[]
+        if self.controller and not self.grown:
+            # The retrievers may report from other threads
+            loop=get_running_loop()
+            self.grown=lambda: loop.call_soon_threadsafe(self.slot.set)
+            self.controller.listeners.append(self.grown)
+
+        self.feeder=create_task(self.feed(it))
+        self.tasks={create_task(self.worker()) for _ in range(self.num_tasks)}
+        self.tasks.update((self.feeder, create_task(self.grimreaper())))
+        try:
+            while True:
+                r=await self.results.get()
+                if r is finished: break
+                i, res=r
+                yield res
+                # The consumer has asked for more, so it's done with it
+                if self.journal: self.journal.finish(i)
+        finally:
+            await self.stop()
+
+    async def feed(self, it):
+        '''Puts the items from it to toget as there's space'''
+        try:
+            if hasattr(it, '__aiter__'):
+                async for i in it: await self.put(i)
+            else:
+                for i in it: await self.put(i)
+        except CancelledError:
+            raise
+        except Exception:
+            lg.exception('Exception in the input')
+
+    async def put(self, i):
+        self.held=i
+        while self.toget.qsize() >= self.queue_size or \
+              self.num_deferred >= self.queue_size:
+            self.space.clear()
+            await self.space.wait()
+        self.toget.put_nowait(entry(i, 0, None, next(self.seq)))
+        self.held=None
 
     async def grimreaper(self):
-        lg.debug('In grimreaper')
-
+        '''Ends run() when all the items are done'''
+        await self.feeder # All the input is in the queue
         await self.toget.join()
+        lg.debug('All items are done')
+        await self.results.put(finished)
 
-        # Extender's to die too
-        self.extender_task.cancel()
-        with suppress(CancelledError):
-            await wait([self.extender_task], loop=self.loop) # Discard
-
-        lg.debug('Closing the loop')
-        self.loop.stop()
-
-        lg.debug('Out grimreaper')
-
-    async def extender(self):
-        '''Enqueues another bunch of items, returns the number enqueued'''
-
-        #set_trace()
-        # Putting initial requests array
-        await self.extend(self.initial_toget)
-
-        # Now start the task which will wait for all the items to be processed
-        self.grimreaper_task=ensure_future(self.grimreaper())
-        self.args[self.grimreaper_task]='grimreaper'
-
+    async def worker(self):
+        '''Takes the items one by one with its own object'''
+        o=None
+        me=current_task()
         while True:
-            lg.debug('Extender before item get')
+            e=await self.toget.get() # Get the item to process
+            self.space.set()
+            i=e[3]
+            k=None # Key of the item if it's limited
+            gated=False # Let in by the controller
+            parsed=False # Handed to the parse stage, which finishes it
             try:
-                i=await self.toget.get() # Get the item to process
+                if e[1] < time():
+                    lg.warning('Past the deadline: {}'.format(i))
+                    self.expired+=1
+                    continue
+
+                if self.journal and i in self.journal:
+                    lg.debug('Done already: {}'.format(i))
+                    continue
+
+                if self.host_limit or self.limits:
+                    k=self.key(i)
+                    limit=self.limits.get(k, self.host_limit)
+                    if k is None or limit is None:
+                        k=None
+                    elif self.active[k] >= limit:
+                        # Wait for the ones being processed
+                        self.deferred[k].append(e)
+                        self.num_deferred+=1
+                        k=None
+                        continue
+                    else:
+                        self.active[k]+=1
+
+                self.args[me]=i
+                if self.controller:
+                    while self.running >= self.controller.limit:
+                        self.slot.clear()
+                        await self.slot.wait()
+                    self.running+=1
+                    gated=True
+                if o is None: # Only create the objects we need
+                    o=self.init()
+                    self.objects.append(o)
+                if self.journal: self.journal.start(i)
+
+                task=create_task(self.do(o, i))
+                # done_task of the class gets the future, as it used to
+                dt=getattr(o, 'done_task', None)
+                if dt: task.add_done_callback(dt)
+                try:
+                    res=await task
+                except ProxyException as e:
+                    lg.debug('Proxy exception: {}'.format(e))
+                    res=None
+                except CancelledError:
+                    raise
+                except Exception:
+                    lg.exception('Exception in farm')
+                    del self.args[me] # Not done, but it's not to be redeemed
+                    continue
+
+                parse=self.parser(o)
+                if parse and res is not None:
+                    await self.parse_slots.acquire()
+                    t=create_task(self.parse_stage(parse, i, res))
+                    self.tasks.add(t)
+                    self.parsing[t]=i
+                    parsed=True
+                elif res is None:
+                    if self.journal: self.journal.finish(i)
+                else: # The journal is updated when it's taken by the consumer
+                    await self.results.put((i, res))
+                del self.args[me] # Done with it, or parse_stage() is
+            finally:
+                if gated:
+                    self.running-=1
+                    self.slot.set()
+                if k is not None: self.release(k)
+                if not parsed: self.toget.task_done()
+
+    def parser(self, o):
+        '''The parse() staticmethod of the class of o, None if there's no such'''
+        cls=type(o)
+        if cls not in self.parsers:
+            fn=getattr_static(cls, 'parse', None)
+            self.parsers[cls]=cls.parse if isinstance(fn, staticmethod) else None
+        return self.parsers[cls]
+
+    async def parse_stage(self, parse, i, res):
+        '''Parses the result of do() for the item in the process pool, while the worker goes on with the next one'''
+        me=current_task()
+        try:
+            try:
+                res=await self.parse(parse, res)
             except CancelledError:
-                lg.debug('Quitting extender')
+                raise # The item stays in parsing, to be redeemed
+            except Exception:
+                lg.exception('Exception in parse')
+                del self.parsing[me] # Not done, but it's not to be redeemed
                 return
-            
-            # Get the object, probably reusing
-            if self.objects.empty() and self.num_objects:
-                # We can create another one
-                o=self.init()
-                self.num_objects-=1
+            if res is None:
+                if self.journal: self.journal.finish(i)
             else:
-                try:
-                    o=await self.objects.get()
-                except CancelledError:
-                    lg.debug('Returning retrieved item back to toget: {}'.format(i))
-                    await self.toget.put(i)
-                    return # Leave the routine right here
-
-            lg.debug('Extender after objects.get()')
-            task=ensure_future(self.do(o, i))
-            try: # Add respective done_task from the class or farm default
-                dt=o.done_task
-            except AttributeError:
-                dt=self.done_task
-            task.add_done_callback(dt)
-            self.args[task]=i
-            #lg.debug('added task {} {}'.format(id(task), i))
-        
-    async def extend(self, arr):
-        for i in arr: await self.toget.put(i)
+                await self.results.put((i, res))
+            del self.parsing[me]
+        finally:
+            self.parse_slots.release()
+            self.tasks.discard(me)
+            self.toget.task_done()
+
+    def release(self, k):
+        '''Frees a place for the key, requeueing an item deferred for it. It's done before task_done(), so toget.join() doesn't return while any are deferred.'''
+        self.active[k]-=1
+        if not self.active[k]: del self.active[k]
+        q=self.deferred.get(k)
+        if q:
+            self.toget.put_nowait(q.popleft())
+            self.num_deferred-=1
+            if not q: del self.deferred[k]
+            self.space.set()
+
+    async def stop(self):
+        '''Cancels our tasks, collects the unprocessed items in self.remaining and closes the objects. Returns self.remaining.'''
+        if self.grown:
+            self.controller.listeners.remove(self.grown)
+            self.grown=None
+        tasks=[t for t in self.tasks if not t.done()]
+        for t in tasks: t.cancel()
+        await gather(*tasks, return_exceptions=True)
+        self.tasks.clear()
+
+        self.remaining.extend(self.args.values()) # Interrupted
+        self.args.clear()
+        self.remaining.extend(self.parsing.values())
+        self.parsing.clear()
+        for q in self.deferred.values(): self.remaining.extend(e[3] for e in q)
+        self.deferred.clear()
+        self.active.clear()
+        self.num_deferred=0
+        self.remaining.extend(self.deplete_queue())
+        while not self.results.empty(): # Done, but not taken by the consumer
+            r=self.results.get_nowait()
+            if r is not finished: self.remaining.append(r[0])
+        if self.held is not None: # Taken from the input, but not queued
+            self.remaining.append(self.held)
+            self.held=None
+        if self.remaining:
+            lg.info('Unprocessed items: {}'.format(len(self.remaining)))
+
+        await self.close()
+        return self.remaining
+
+    def metrics(self):
+        '''Queue depth, the items deferred and expired, and the concurrency'''
+        return {'depth': self.toget.qsize() if self.toget else 0,
+                'deferred': self.num_deferred, 'expired': self.expired,
+                'running': self.running, 'controller': self.controller.metrics()
+                if self.controller else None}
+
+    def deplete_queue(self):
+        '''Takes all the items from toget, in their order'''
+        q=[]
+        while not self.toget.empty(): q.append(self.toget.get_nowait()[3])
+        return q
+
+    async def close(self):
+        for o in self.objects:
+            with suppress(AttributeError): await o.close()
+        self.objects.clear()
+        for c in self.fronts.values(): await c.close()
+        self.fronts.clear()
+        if self.connector:
+            await close_connector(self.connector)
+            self.connector=None
+        if self.executor:
+            self.executor.shutdown()
+            self.executor=None
+
+    async def extend(self, arr, priority=None, deadline=None):
+        '''Adds the items while run() goes, with the priority (extend_priority by default, so they go before the input) and deadline. These are not limited by queue_size (do() calls it, waiting here could block all the workers), but the input waits until they're taken.'''
+        if priority is None: priority=self.extend_priority
+        for i in arr:
+            self.toget.put_nowait(entry(i, priority, deadline, next(self.seq)))
         lg.info('Queue len: {}'.format(self.toget.qsize()))
-        
+
+    async def parse(self, fn, *args):
+        '''Runs fn(*args) in the process pool and returns its result, so the CPU work doesn't hold up the requests in flight. fn and args must be picklable: a module level function or a staticmethod.'''
+        if self.parse_workers == 0: return fn(*args)
+        if not self.executor:
+            self.executor=ProcessPoolExecutor(self.parse_workers)
+        return await get_running_loop().run_in_executor(self.executor, fn, *args)
+
     async def do(self, o, i):
-        '''We have a pool of retriever objects. First we get one (or wait until it's ready), then invoke o.do(). We can use this farm several times — just by extending it (the objects remain live) — to gather the results as many times as we want.
+        '''Invokes o.do() for the item. Items can be added with extend() while it runs, and run() can be called again afterwards. done_task() of o gets the result of do(), before the parse() stage.
 '''
         with suppress(AttributeError):
             if not o.f: o.f=self # Set to the current farm
 
         lg.info('Item: {}'.format(i))
 
-        interrupted=False
         try:
             # Handle the item with do() function of the class, passing
             # parameters depending on the nature of the argument: can be
             # presented as several arguments to make things easier. do()
-            # function must return one result, that will be collected with
-            # respective done_task()
+            # function must return one result
             if isinstance(i, (tuple, list)): # Present as arguments
                 res=await o.do(*i)
             else:
                 res=await o.do(i)
-        except CancelledError: # Don't discard the args of these two exceptions
+        except CancelledError:
             lg.debug('do(): cancelled')
-            interrupted=True
-            return None
-        except KeyboardInterrupt:
-            lg.debug('do(): keyboard interrupt')
-            interrupted=True
             raise
-        except ProxyException as e:
-            raise # Propagate to task_done()
-        except:
-            lg.exception('Exception in farm')
-            res=None
-        finally: # Return the object, so others may continue
-            await self.objects.put(o) # We'll wait here to evade uncontrolled spawning
-            self.toget.task_done()
-            if not interrupted: # Leave to retrieve
-                del self.args[Task.current_task()] # Prune unneeded arguments
+        # Other exceptions go to done_task() and the worker
 
         return res
-
-    async def deplete_queue(self, loop):
-        q=[]
-        while not self.toget.empty(): q.append(await self.toget.get())
-
-        return q
-        
-    def stopall(self, loop):
-        '''Cancels all tasks and gets puts unretrieved input items back into the queue''' 
-        lg.warning('In stopall')
-
-        results=[]
-        cancelled=[] # Tasks cancelled, we'll wait for their return
-        # TODO: Need to cancel only our threads!
-        for i in Task.all_tasks():
-            lg.debug('TASK {:04x}: {}'.format(id(i)%(1<<16), i))
-            if i.done(): # Finished
-                try:
-                    res=i.result()
-                    lg.debug('RESULT: {}'.format(res))
-                    results.append(res)
-                except KeyboardInterrupt: # The task that got interrupt
-                    lg.debug('INTERRUPTED: {}'.format(self.args.get(i)))
-                continue
-
-            #res.append(self.args[i])
-            i.cancel()
-            cancelled.append(i)
-
-        print('CANCELLED: {} {}'.format(len(cancelled), len(Task.all_tasks())))
-        for i in cancelled:
-        #for i in Task.all_tasks():
-            lg.debug('TASK {:04x}: {}'.format(id(i)%(1<<16), i))
-            try:
-                res=loop.run_until_complete(i)
-            except KeyboardInterrupt:
-                lg.debug('after ruc: interrupt: {}'.format(self.args.get(i)))
-                continue
-            except CancelledError:
-                lg.debug('after ruc: cancel')
-                continue
-            lg.info('AFTER RUC: {}'.format(res))
-            results.append(res)
-
-        # Results have been through the done_task already, so actually there's no need in them
-        if 0:
-            lg.info('results: {}, args: {}'.format(len(results), len(self.args)))
-        else:
-            lg.debug('results: {}, args: {}'.format(results, self.args))
-        lg.info('toget: {}'.format(self.toget.qsize()))
-
-        toget_new=[v for k, v in self.args.items()
-                   if k not in (self.grimreaper_task, self.extender_task)]
-
-        lg.info('Retrieving queue')
-        task=ensure_future(self.deplete_queue(loop))
-        res=loop.run_until_complete(task)
-        toget_new.extend(res)
-
-        return results, toget_new
-
@@ -0,0 +1,120 @@
+#!/usr/bin/python3
+
+'''This module provides a class to run retrievers in several processes, each of
+them running a threaded farm, so that parsing in do() is not limited to one core
+by the GIL.
+
+f=farm(4, 50, handle_letter, all_letters, pp=pp)
+for res in f.run(): print(res)
+pp.write() # Has the statuses from all the processes
+
+The processes are forked, so init and the proxypool are inherited rather than
+pickled; the items go to the processes through a queue and the results come
+back through another one, so both are pickled. Each process gets its part of
+the proxypool (every num_procs-th proxy), and the statuses of the proxies are
+sent back to the parent's pool every sync_interval seconds. The farms in the
+processes are not extendable.
+'''
+
+from multiprocessing import get_context
+from threading import Thread, Event
+from logging import getLogger
+from os import getpid
+
+from .farm import farm as thread_farm
+
+lg=getLogger(__name__)
+
+class farm:
+    '''The same items and results as in the threaded farm, spread over num_procs processes with num_threads threads each.'''
+    def __init__(self, num_procs, num_threads, init, it, pp=None,
+                 sync_interval=5, queue_size=1000, **kwargs):
+        '''pp is the proxypool the retrievers use, to be partitioned between the processes. queue_size limits the items and results in transit. kwargs go to the threaded farms.'''
+        self.num_procs=num_procs
+        self.num_threads=num_threads
+        self.init=init
+        self.it=it
+        self.pp=pp
+        self.sync_interval=sync_interval
+        self.queue_size=queue_size
+        self.kwargs=kwargs
+        self.stopping=False
+
+    def feed(self):
+        '''Feeder thread in the parent, puts the items for the processes'''
+        for i in self.it:
+            if self.stopping: break
+            self.inq.put(i)
+        for _ in range(self.num_procs): self.inq.put(None) # End markers
+
+    def child(self, n):
+        '''Runs in the process n'''
+        done=Event()
+
+        def sync(): # Send the proxy statuses which have changed
+            state=self.pp.snapshot()
+            changed={k: v for k, v in state.items() if sent.get(k) != v}
+            if changed: self.outq.put(('s', changed))
+            sent.update(changed)
+
+        def syncer():
+            while not done.wait(self.sync_interval): sync()
+
+        try:
+            if self.pp:
+                self.pp.partition(n, self.num_procs)
+                sent=self.pp.snapshot()
+                st=Thread(target=syncer, daemon=True)
+                st.start()
+
+            f=thread_farm(self.num_threads, self.init,
+                          iter(self.inq.get, None), **self.kwargs)
+            try:
+                for res in f.run(): self.outq.put(('r', res))
+            finally:
+                f.close()
+                done.set()
+                if self.pp: sync()
+        except:
+            lg.exception('Process {} ({})'.format(n, getpid()))
+        finally:
+            self.outq.put(('x', n)) # Mark the process has finished
+
+    def run(self):
+        '''Starts the processes and yields the results as they come'''
+        ctx=get_context('fork')
+        self.inq=ctx.Queue(self.queue_size)
+        self.outq=ctx.Queue(self.queue_size)
+        procs=[ctx.Process(target=self.child, args=(n,), name='farm-{}'.format(n))
+               for n in range(self.num_procs)]
+        for p in procs: p.start()
+        feeder=Thread(target=self.feed, daemon=True)
+        feeder.start()
+
+        running=self.num_procs
+        try:
+            while running:
+                try:
+                    kind, res=self.outq.get()
+                except KeyboardInterrupt:
+                    # The processes got it too, wait for them to wind down
+                    lg.warning('Stopping the feeder')
+                    self.stopping=True
+                    continue
+                if kind == 'r':
+                    yield res
+                elif kind == 's':
+                    self.pp.apply(res)
+                else:
+                    lg.info('Process {} has finished'.format(res))
+                    running-=1
+        finally:
+            self.stopping=True
+            # Nobody may read the items left in the queue, don't wait at exit
+            # to flush them
+            self.inq.cancel_join_thread()
+            if running: # Closed early, nobody is to read the results
+                for p in procs: p.terminate()
+            for p in procs: p.join()
+            self.inq.close()
+            self.outq.close()
@@ -0,0 +1,114 @@
+'''Journal of the items a farm has started and finished, so a job that was
+interrupted or crashed can be run again on the same input: the finished items
+are skipped, the ones that were in flight are done again.
+
+j=journal('job.journal')
+f=farm(10, init, it, journal=j)
+for res in f.run(): print(res)
+j.close()
+
+It's an append-only text file of lines "S <hash>" (started) and "D <hash>"
+(done), hash being of key(item), repr() by default, so the items must have a
+stable repr. Every line is flushed to the OS right away, so it survives the
+process being killed; it's fsync'ed every sync lines and on close(). compact()
+drops the lines of no use any more.
+'''
+
+from os import fsync, replace
+from hashlib import sha1
+from threading import Lock
+from contextlib import suppress
+from logging import getLogger
+
+lg=getLogger(__name__)
+
+class journal:
+    '''Thread-safe, one journal can serve several farms of the same job'''
+    def __init__(self, fn, key=repr, sync=1000):
+        self.fn=fn
+        self.key=key
+        self.sync=sync
+        self.lock=Lock()
+        self.finished=set() # Hashes of the items done
+        self.pending=set() # Started, not done (yet, or because of a crash)
+        newline=False # Need to end the line cut by a crash
+        with suppress(FileNotFoundError):
+            with open(fn) as ff:
+                for line in ff:
+                    newline=not line.endswith('\n')
+                    self.load(line)
+            lg.info('Journal {}: {} done, {} to retry'.format(
+                fn, len(self.finished), len(self.pending)))
+        self.f=open(fn, 'a')
+        if newline: self.f.write('\n')
+        self.unsynced=0
+
+    def load(self, line):
+        try:
+            op, h=line.split()
+            h=bytes.fromhex(h)
+        except ValueError: # Cut off by a crash
+            return
+        if op == 'S':
+            if h not in self.finished: self.pending.add(h)
+        elif op == 'D':
+            self.pending.discard(h)
+            self.finished.add(h)
+
+    def hash(self, i):
+        return sha1(self.key(i).encode()).digest()[:16]
+
+    def __contains__(self, i):
+        '''Whether the item is done'''
+        return self.hash(i) in self.finished
+
+    def filter(self, it):
+        '''Yields the items of it not done yet'''
+        for i in it:
+            if i not in self: yield i
+
+    def write(self, op, h):
+        '''The lock must be held'''
+        self.f.write('{} {}\n'.format(op, h.hex()))
+        self.f.flush()
+        self.unsynced+=1
+        if self.unsynced >= self.sync:
+            fsync(self.f.fileno())
+            self.unsynced=0
+
+    def start(self, i):
+        h=self.hash(i)
+        with self.lock:
+            self.pending.add(h)
+            self.write('S', h)
+
+    def finish(self, i):
+        h=self.hash(i)
+        with self.lock:
+            self.pending.discard(h)
+            self.finished.add(h)
+            self.write('D', h)
+
+    def stats(self):
+        with self.lock:
+            return {'done': len(self.finished), 'pending': len(self.pending)}
+
+    def compact(self):
+        '''Rewrites the file with the done items only, the started ones are of
+no use but for stats'''
+        with self.lock:
+            with open(self.fn+'.part', 'w') as ff:
+                for h in self.finished: ff.write('D {}\n'.format(h.hex()))
+                ff.flush()
+                fsync(ff.fileno())
+            self.f.close()
+            replace(self.fn+'.part', self.fn)
+            self.f=open(self.fn, 'a')
+            self.unsynced=0
+
+    def close(self):
+        with self.lock:
+            if self.f.closed: return
+            self.f.flush()
+            fsync(self.f.fileno())
+            self.f.close()
@@ -0,0 +1,119 @@
+'''Re-tests the disabled and bad proxies of a proxypool in the background, and
+puts the ones that pass back into rotation with pp.revive().
+
+pr=prober(pp, 'http://example.com/')
+pr.start() # With the threaded proxypool: a thread with its own event loop
+...
+pr.stop()
+
+Or in the event loop along with an async farm:
+
+task=asyncio.create_task(pr.run())
+...
+pr.stop(); await task
+
+Every proxy is checked first interval seconds after it's found out of rotation,
+then the delay grows by factor up to max_delay while it keeps failing. The
+requests never wait for the prober, it only takes the lock of the pool to see
+which proxies are out and to revive them.
+'''
+
+from asyncio import Event, gather, get_running_loop, run, wait_for, \
+    TimeoutError as aio_TimeoutError
+from heapq import heappush, heappop
+from threading import Thread
+from collections import Counter
+from time import time
+from logging import getLogger
+
+from .proxyfilter import proxyfilter
+from .proxypool_common import F_OUT
+
+lg=getLogger(__name__)
+
+class prober:
+    def __init__(self, pp, url, interval=60, factor=2, max_delay=3600,
+                 concurrency=20, scan_interval=10, **kwargs):
+        '''url: the page to check the proxies with, kwargs (timeouts, check, headers) are the same as for proxyfilter
+concurrency: how many proxies are checked at a time
+scan_interval: how often the pool is looked at for the proxies gone out'''
+        self.pp=pp
+        self.filter=proxyfilter(pp, url, concurrency, **kwargs)
+        self.interval=interval
+        self.factor=factor
+        self.max_delay=max_delay
+        self.concurrency=concurrency
+        self.scan_interval=scan_interval
+        self.delays={} # Current delay by proxy key
+        self.due=[] # Heap of (time, key)
+        self.counts=Counter() # 'revived' and 'failed'
+        self.stopping=False
+        self.loop=None
+        self.wakeup=None
+        self.thread=None
+
+    def scan(self, now):
+        '''Schedules the proxies which have gone out of rotation'''
+        for p in self.pp.sidelined():
+            if p.p in self.delays: continue
+            self.delays[p.p]=self.interval
+            heappush(self.due, (now+self.interval, p.p))
+
+    async def check(self, s, p):
+        flag, latency=await self.filter.probe(s, p)
+        if flag == 'G':
+            self.pp.revive(p, latency)
+            self.counts['revived']+=1
+            del self.delays[p.p]
+        else:
+            self.counts['failed']+=1
+            delay=self.delays[p.p]=min(self.delays[p.p]*self.factor,
+                                       self.max_delay)
+            heappush(self.due, (time()+delay, p.p))
+
+    def take(self, now):
+        '''Up to concurrency proxies due to be checked'''
+        res=[]
+        while self.due and self.due[0][0] <= now and len(res) < self.concurrency:
+            dummy, k=heappop(self.due)
+            p=self.pp.master_plist.get(k)
+            if p and p.bits & F_OUT:
+                res.append(p)
+            else: # Back in rotation by other means, or gone
+                self.delays.pop(k, None)
+        return res
+
+    async def run(self):
+        self.loop=get_running_loop()
+        self.wakeup=Event()
+        scanned=0
+        async with self.filter.session() as s:
+            while not self.stopping:
+                now=time()
+                if now-scanned >= self.scan_interval:
+                    self.scan(now)
+                    scanned=now
+                plist=self.take(now)
+                if plist:
+                    await gather(*(self.check(s, p) for p in plist))
+                    continue
+                delay=self.scan_interval
+                if self.due: delay=min(delay, self.due[0][0]-now)
+                try:
+                    await wait_for(self.wakeup.wait(), max(delay, 0))
+                except aio_TimeoutError:
+                    pass
+        lg.info('Prober: {}'.format(self.counts))
+
+    def start(self):
+        '''Runs the prober in a daemon thread with its own event loop'''
+        self.thread=Thread(target=lambda: run(self.run()), name='prober',
+                           daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping=True
+        if self.loop: self.loop.call_soon_threadsafe(self.wakeup.set)
+        if self.thread:
+            self.thread.join()
+            self.thread=None
@@ -0,0 +1,109 @@
+'''Checks the proxies of a proxypool asynchronously, many at a time, and marks
+them in master_plist: 'G' for the ones that work (their latency goes to p.time),
+'B' for the ones that fail or are too slow, 'D' for the ones the connection to
+is refused or that refuse to proxy.
+
+pp=proxypool('proxies.lst')
+f=proxyfilter(pp, 'http://example.com/', concurrency=500, enough=100)
+print(asyncio.run(f.run()))
+pp.write()
+
+It's a faster replacement of running a farm over the pool marked with 'O' (see
+set_plist_for_filter()).
+'''
+
+from asyncio import create_task, gather, current_task, \
+    TimeoutError as aio_TimeoutError
+from collections import Counter
+from time import time
+from logging import getLogger
+
+from aiohttp import ClientSession, TCPConnector, ClientTimeout, \
+    ClientProxyConnectionError, ClientHttpProxyError, ClientError
+
+lg=getLogger(__name__)
+
+class proxyfilter:
+    '''The proxies to check are the ones without status, or if there are none, all but the good ones (like set_plist_for_filter()), unless given.'''
+    def __init__(self, pp, url, concurrency=500, connect_timeout=3.,
+                 first_byte_timeout=5., timeout=15., enough=None, check=None,
+                 headers={}, proxies=None):
+        '''url: the page to get through the proxies
+concurrency: how many proxies are checked at a time
+connect_timeout, first_byte_timeout: seconds to connect to the proxy, and then to get the response headers; timeout: for the whole check
+enough: stop when that many good proxies are found, the rest are left as they are
+check(status, body): whether the response is good, status 200 by default; the body is read only if it's given
+proxies: the proxies (of pp) to check'''
+        self.pp=pp
+        self.url=url
+        self.concurrency=concurrency
+        self.timeout=ClientTimeout(total=timeout, sock_connect=connect_timeout,
+                                   sock_read=first_byte_timeout)
+        self.enough=enough
+        self.check=check
+        self.headers=headers
+        self.proxies=proxies
+        self.counts=Counter() # Verdicts so far
+        self.tasks=[]
+
+    def select(self):
+        plist=self.pp.master_plist.values()
+        res=[p for p in plist if not p.flags.strip('O')]
+        if not res: res=[p for p in plist if 'G' not in p.flags]
+        return res
+
+    def session(self):
+        '''The session to probe with'''
+        connector=TCPConnector(limit=self.concurrency, force_close=True)
+        return ClientSession(connector=connector, timeout=self.timeout)
+
+    async def probe(self, s, p):
+        '''Returns the verdict for the proxy and the latency till the headers'''
+        headers=dict(self.headers)
+        if p.creds: headers['Proxy-Authorization']=p.creds
+        start=time()
+        try:
+            async with s.get(self.url, proxy=p.p or None, headers=headers,
+                             allow_redirects=False) as r:
+                latency=time()-start
+                if self.check:
+                    ok=self.check(r.status, await r.read())
+                else:
+                    ok=r.status == 200
+        except (ClientProxyConnectionError, ClientHttpProxyError) as e:
+            lg.debug('{}: {}'.format(p.p, e))
+            return 'D', None # Not a proxy, or not for us
+        except (ClientError, aio_TimeoutError, OSError, ValueError) as e:
+            lg.debug('{}: {}'.format(p.p, type(e).__name__))
+            return 'B', None
+        return ('G' if ok else 'B'), latency
+
+    async def worker(self, s, it):
+        for p in it:
+            flag, latency=await self.probe(s, p)
+            self.pp.mark(p, flag, latency)
+            self.counts[flag]+=1
+            total=sum(self.counts.values())
+            if not total % 1000: lg.info('Filtered {}: {}'.format(total, self.counts))
+            if self.enough and self.counts['G'] >= self.enough:
+                lg.info('Found {} good proxies'.format(self.counts['G']))
+                self.stop()
+                return
+
+    def stop(self):
+        '''Cancels the checks in progress, their proxies are left as they are'''
+        for t in self.tasks:
+            if t is not current_task(): t.cancel()
+
+    async def run(self):
+        '''Checks the proxies, returns the Counter of the verdicts'''
+        plist=self.proxies if self.proxies is not None else self.select()
+        lg.info('Checking {} proxies'.format(len(plist)))
+        it=iter(plist)
+        async with self.session() as s:
+            self.tasks=[create_task(self.worker(s, it))
+                        for _ in range(min(self.concurrency, len(plist)))]
+            for res in await gather(*self.tasks, return_exceptions=True):
+                if isinstance(res, Exception): lg.error('Filter: {!r}'.format(res))
+        lg.info('Filtered: {}'.format(self.counts))
+        return self.counts
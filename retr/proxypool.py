@@ -1,34 +1,98 @@
 #!/usr/bin/python3
 
-from threading import Lock
+from threading import Condition, Lock
+from asyncio import sleep
 from logging import getLogger, ERROR
 from datetime import datetime, timedelta
 
-from .proxypool_common import proxypool as pp_common
+from .proxypool_common import proxypool as pp_common, ChillingException
 
 lg=getLogger(__name__)
     
 class proxypool(pp_common):
 
     def __init__(self, *args, **kwargs):
-        self.lock=Lock()
+        # Waiting for the chilling proxies is done on the condition, so the
+        # lock is released meanwhile
+        self.lock=Condition()
+        self.write_lock=Lock() # Writes can't go at once, but don't block the pool
         super().__init__(*args, **kwargs)
         
     def set_status(self, *args, **kwargs):
         with self.lock:
             super().set_status(*args, **kwargs)
+            self.lock.notify() # The proxy may be ready again
                 
     def release_proxy(self, *args):
         with self.lock:
             super().release_proxy(*args)
+            self.lock.notify()
 
     # def active_number(self):
     #     with self.lock: super().active_number()
 
-    def get_proxy(self) -> 'proxy':
+    def get_proxy(self, *args, block=True, **kwargs) -> 'proxy':
+        '''Waits for the chilling proxies to wake up, unless block is False'''
         with self.lock:
-            return super().get_proxy()
+            while True:
+                try:
+                    return super().get_proxy(*args, **kwargs)
+                except ChillingException as e:
+                    if not block: raise
+                    self.lock.wait(e.args[0])
+
+    async def get_proxy_async(self, *args, **kwargs) -> 'proxy':
+        '''Never waits on the condition, that would block the event loop: sleeps
+asynchronously while the proxies are chilling'''
+        while True:
+            try:
+                return self.get_proxy(*args, block=False, **kwargs)
+            except ChillingException as e:
+                await sleep(e.args[0])
+
+    def throttle(self, *args, **kwargs):
+        with self.lock:
+            return super().throttle(*args, **kwargs)
+
+    def record(self, *args, **kwargs):
+        with self.lock:
+            super().record(*args, **kwargs)
+
+    def stats(self, *args, **kwargs):
+        with self.lock:
+            return super().stats(*args, **kwargs)
+
+    def snapshot(self):
+        with self.lock:
+            return super().snapshot()
+
+    def apply(self, *args):
+        with self.lock:
+            super().apply(*args)
+            self.lock.notify_all()
+
+    def mark(self, *args, **kwargs):
+        with self.lock:
+            super().mark(*args, **kwargs)
+            self.lock.notify()
+
+    def sidelined(self):
+        with self.lock:
+            return super().sidelined()
+
+    def next_wake(self):
+        with self.lock:
+            return super().next_wake()
             
     def write(self, **kwargs):
-        with self.lock:
-            super().write(**kwargs)
+        '''Only takes the lock to collect what to write, the file or the store
+is written without it. write_lock keeps the writes in order.'''
+        with self.write_lock:
+            with self.lock:
+                rows=super().rows(**kwargs)
+            try:
+                self.save(rows)
+            except BaseException:
+                with self.lock:
+                    super().unsaved(rows)
+                raise
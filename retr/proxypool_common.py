@@ -5,44 +5,293 @@ from csv import reader, writer
 from collections import OrderedDict, Counter
 from urllib.parse import urlparse
 from base64 import b64encode
-from random import choice
+from random import randrange, betavariate, uniform
+from heapq import heappush, heappop
+from itertools import count, islice
 from time import time
+from array import array
+from asyncio import sleep
 from pdb import set_trace
 
 class NoProxiesException(Exception):
     pass
 
+class ChillingException(NoProxiesException):
+# All usable proxies are chilling out. Argument: seconds until the first one
+# wakes up
+    pass
+
 lg=getLogger(__name__)
 
 class proxy_stats:
-    '''Stats per domain for the given proxy'''
+    '''Stats per domain for the given proxy. The size is fixed: the last window latencies are kept in a ring buffer, the mean and variance of all of them are streamed (Welford).'''
+    __slots__=('last_access', 'latencies', 'pos', 'count', 'mean', 'm2',
+               'latency', 'ok', 'failed')
+    decay=.1 # Weight of the last request in the decayed values below
+    window=32 # How many last latencies to keep for the quantiles
+
     def __init__(self):
         self.last_access=None # Time of last access through this proxy
-        self.latencies=[] # Array of response times through this proxy
+        self.latencies=array('d') # Ring buffer of the last response times
+        self.pos=0 # Where the next latency goes when the buffer is full
+        self.count=0 # How many latencies are accounted in mean and m2
+        self.mean=0.
+        self.m2=0. # Sum of squared differences from the mean
+        self.latency=None # Exponentially weighted moving average of latencies
+        self.ok=0. # Decayed count of successful requests
+        self.failed=0. # Decayed count of failed requests
+
+    def update(self, start, latency=None, ok=True):
+        '''Accounts one request started at start. latency is None if it has failed before we got the response'''
+        self.last_access=start
+        self.ok*=1-self.decay
+        self.failed*=1-self.decay
+        if ok:
+            self.ok+=1
+        else:
+            self.failed+=1
+        if latency is None: return
+
+        if len(self.latencies) < self.window:
+            self.latencies.append(latency)
+        else:
+            self.latencies[self.pos]=latency
+            self.pos=(self.pos+1)%self.window
+        self.count+=1
+        delta=latency-self.mean
+        self.mean+=delta/self.count
+        self.m2+=delta*(latency-self.mean)
+        self.latency=latency if self.latency is None else \
+            self.latency+self.decay*(latency-self.latency)
+
+    def dump(self):
+        '''The state as a list, for JSON'''
+        return [self.last_access, self.latencies.tolist(), self.pos, self.count,
+                self.mean, self.m2, self.latency, self.ok, self.failed]
+
+    def state(self):
+        '''The state as a tuple with the latencies in bytes, quicker to take than
+dump(), see dump_state()'''
+        return (self.last_access, self.latencies.tobytes(), self.pos,
+                self.count, self.mean, self.m2, self.latency, self.ok,
+                self.failed)
+
+    @staticmethod
+    def dump_state(state):
+        '''dump() of the stats state() was taken from'''
+        latencies=array('d')
+        latencies.frombytes(state[1])
+        return [state[0], latencies.tolist(), *state[2:]]
+
+    @classmethod
+    def restore(cls, state):
+        '''The stats from dump()'''
+        st=cls()
+        (st.last_access, latencies, st.pos, st.count, st.mean, st.m2,
+         st.latency, st.ok, st.failed)=state
+        st.latencies.extend(latencies)
+        return st
+
+    def stdev(self):
+        return (self.m2/(self.count-1))**.5 if self.count > 1 else 0.
+
+    def quantile(self, q):
+        '''Quantile of the last window latencies, None if there are none'''
+        if not self.latencies: return None
+        srt=sorted(self.latencies)
+        return srt[min(int(q*len(srt)), len(srt)-1)]
+
+    def merge(self, other):
+        '''Adds the other stats to these, used to sum up the stats across the proxies. The ring buffer keeps the latest window of both.'''
+        if other.last_access is not None and (
+                self.last_access is None or other.last_access > self.last_access):
+            self.last_access=other.last_access
+        self.ok+=other.ok
+        self.failed+=other.failed
+        if not other.count: return
+        count=self.count+other.count
+        delta=other.mean-self.mean
+        self.mean+=delta*other.count/count
+        self.m2+=other.m2+delta*delta*self.count*other.count/count
+        self.latency=other.latency if self.latency is None else \
+            (self.latency*self.count+other.latency*other.count)/count
+        self.count=count
+        for i in other.latencies:
+            if len(self.latencies) < self.window:
+                self.latencies.append(i)
+            else:
+                self.latencies[self.pos]=i
+                self.pos=(self.pos+1)%self.window
 
     def __str__(self):
-        return 'last: {}, avg: {}'.format(self.last_access, sum(self.latencies)/len(self.latencies) if self.latencies else 'N/A')
+        if not self.count:
+            return 'last: {}, ok: {:.2f}, failed: {:.2f}'.format(
+                self.last_access, self.ok, self.failed)
+        return 'last: {}, n: {}, avg: {:.3f}, sd: {:.3f}, p50: {:.3f}, p95: {:.3f}, ewma: {:.3f}, ok: {:.2f}, failed: {:.2f}'.format(
+            self.last_access, self.count, self.mean, self.stdev(),
+            self.quantile(.5), self.quantile(.95), self.latency,
+            self.ok, self.failed)
+
+class ewma_scoring:
+    '''Proxy selection by the stats for the domain: the best success rate per second of latency wins. Only sample proxies from the beginning of the ready list are considered, so the usual ordering still matters. Proxies without stats for the domain get the benefit of the doubt: prior_latency and no failures.
+Pass an instance as scoring to the proxypool, and the domain to get_proxy().'''
+    def __init__(self, sample=8, prior_latency=1.):
+        self.sample=sample
+        self.prior_latency=prior_latency
+
+    def score(self, p, domain):
+        st=p.domain_stats(domain)
+        if not st: return 1/self.prior_latency
+        return (st.ok+1)/(st.ok+st.failed+1)/(st.latency or self.prior_latency)
+
+    def pick(self, candidates, domain):
+        return max(candidates, key=lambda _: self.score(_, domain))
+
+class thompson_scoring(ewma_scoring):
+    '''Like ewma_scoring, but the success rate is sampled from its beta distribution, so less known proxies are explored more'''
+    def score(self, p, domain):
+        st=p.domain_stats(domain)
+        if not st: return betavariate(1, 1)/self.prior_latency
+        return betavariate(st.ok+1, st.failed+1)/(st.latency or self.prior_latency)
+
+class token_bucket:
+    '''rate tokens per second, up to burst of them are saved while idle'''
+    __slots__=('rate', 'burst', 'tokens', 'stamp')
+
+    def __init__(self, rate, burst=1):
+        self.rate=rate
+        self.burst=burst
+        self.tokens=burst
+        self.stamp=time()
+
+    def wait(self, now):
+        '''Seconds until a token is there, 0 if it's there already'''
+        if now > self.stamp:
+            self.tokens=min(self.burst, self.tokens+(now-self.stamp)*self.rate)
+            self.stamp=now
+        return 0 if self.tokens >= 1 else (1-self.tokens)/self.rate
+
+    def take(self):
+        '''Call right after wait() has returned 0'''
+        self.tokens-=1
+
+    def full(self, now):
+        '''Whether it has been idle long enough to have burst tokens again, a new bucket would be the same then'''
+        return self.tokens+(now-self.stamp)*self.rate >= self.burst
+
+class politeness:
+    '''Proactive rate limits for the domains, as token buckets. domain_rate is requests per second to the domain through all the proxies, proxy_rate is requests per second to the domain through every proxy. Both can be dicts by domain, with the default under None key; no rate means no limit. burst is how many requests may go at once after some idle time.
+Pass an instance as politeness to the proxypool. get_proxy() prefers the proxies allowed to go to the domain among the sample first ready ones, and the retrievers wait on proxypool.throttle() before every request.
+Buckets are kept only for the limited domains, and every sweep_interval seconds the ones idle long enough to be full are dropped.'''
+    def __init__(self, domain_rate=None, proxy_rate=None, burst=1, sample=8,
+                 sweep_interval=60):
+        self.domain_rate=domain_rate
+        self.proxy_rate=proxy_rate
+        self.burst=burst
+        self.sample=sample
+        self.sweep_interval=sweep_interval
+        self.domains={} # Buckets by domain
+        self.proxies={} # Buckets by (proxy, domain)
+        self.swept=time()
+
+    def bucket(self, buckets, key, rate, domain):
+        b=buckets.get(key)
+        if b is None:
+            if isinstance(rate, dict): rate=rate.get(domain, rate.get(None))
+            if not rate: return None # Not limited, nothing to keep
+            b=buckets[key]=token_bucket(rate, self.burst)
+        return b
+
+    def sweep(self, now):
+        '''Drops the full buckets'''
+        for buckets in (self.domains, self.proxies):
+            for k in [k for k, b in buckets.items() if b.full(now)]:
+                del buckets[k]
+        self.swept=now
+
+    def allowed(self, p, domain, now):
+        '''Whether the proxy may go to the domain right now, as far as its own limit is concerned'''
+        b=self.bucket(self.proxies, (p.p, domain), self.proxy_rate, domain)
+        return not b or not b.wait(now)
+
+    def take(self, p, domain, now):
+        '''Takes the tokens for a request. Returns 0 on success, or how many seconds to wait before trying again'''
+        if now-self.swept >= self.sweep_interval: self.sweep(now)
+        buckets=(self.bucket(self.domains, domain, self.domain_rate, domain),
+                 self.bucket(self.proxies, (p.p, domain), self.proxy_rate,
+                             domain))
+        delay=max(_.wait(now) if _ else 0 for _ in buckets)
+        if delay: return delay
+        for b in buckets:
+            if b: b.take()
+        return 0
+
+class circuit_breaker:
+    '''Takes the place of disabling the proxies for life. When a proxy would be disabled (max_retries downvotes, or 'D' status like a timeout with discard_timeout) its circuit opens: it chills out for base*factor**(opens-1) seconds, up to max_cooldown, give or take jitter of it, so that the proxies tripped together don't come back together. When it wakes up the circuit is half-open: the first failure opens it again for longer, the first success closes it. With max_opens set, the proxy is disabled after all once it has been opened that many times in a row.
+Pass an instance as breaker to the proxypool. The number of openings is kept in p.opens and written by write() along with wake_time.'''
+    def __init__(self, base=30, factor=2, max_cooldown=3600, jitter=.2,
+                 max_opens=None):
+        self.base=base
+        self.factor=factor
+        self.max_cooldown=max_cooldown
+        self.jitter=jitter
+        self.max_opens=max_opens
+
+    def cooldown(self, opens):
+        '''Seconds to keep the circuit open after opens openings in a row'''
+        cooldown=min(self.base*self.factor**(opens-1), self.max_cooldown)
+        return cooldown*uniform(1-self.jitter, 1+self.jitter)
+
+    @staticmethod
+    def state(p):
+        '''The state of the proxy's circuit: closed, open or half-open'''
+        if not p.opens: return 'closed'
+        return 'open' if p.bits & F_C else 'half-open'
+
+# The flags of the proxy as bits, in the alphabetical order of their letters
+F_B, F_C, F_D, F_G, F_O, F_P=(1 << _ for _ in range(6))
+F_OUT=F_B|F_D # Out of rotation
+flag_letters='BCDGOP'
+# The flags string for every combination of the bits, and back
+flag_strings=tuple(''.join(c for i, c in enumerate(flag_letters) if n >> i & 1)
+                   for n in range(1 << len(flag_letters)))
+flag_bits={v: k for k, v in enumerate(flag_strings)}
+
+def to_bits(flags):
+    '''The bits of the flags string, in any order'''
+    try:
+        return flag_bits[flags]
+    except KeyError:
+        res=0
+        for c in flags:
+            i=flag_letters.find(c)
+            if i == -1: raise ValueError('Unknown flag {!r}'.format(c))
+            res|=1 << i
+        return res
 
 class proxy:
-    '''Proxy with state'''
+    '''Proxy with state. The flags are kept as bits (see F_*), flags is the string view of them.'''
+    __slots__=('p', 'creds', 'bits', 'tries', 'wake_time', 'opens', 'time',
+               '_stats')
 
     def __init__(self, p, flags=''):
         p=p.strip()
 
         self.tries=0 # Number of timeout retries
         self.wake_time=None
-        
+        self.opens=0 # Circuit openings in a row, see circuit_breaker
+
         # None: usual proxy, or before being filtered
         # 'O': the proxy will be used once, and then we'll have a result or an Exception (used for filtering).
         # 'G': good proxy (marked by filter)
         # 'B': bad proxy (marked by filter)
         # 'P': in addition to 'G', proven proxy. We've got something through this proxy.
         # 'D': Disable for life (for example we're over daily limit and no chance to sleep it off)
-        # 'C': Chilling out, the proxy needs to rest, wake_time will tell when 
-        self.flags=flags
-        
+        # 'C': Chilling out, the proxy needs to rest, wake_time will tell when
+        self.bits=to_bits(flags)
+
         self.creds=None
-        self.stats={} # Domain stats for this proxy. Dict by domain
+        self._stats=None # Domain stats for this proxy, created when needed
         self.time=0
         
         if p:
@@ -67,51 +316,214 @@ class proxy:
             # want to use it)
             self.p=''
             
+    @property
+    def flags(self):
+        return flag_strings[self.bits]
+
+    @flags.setter
+    def flags(self, flags):
+        self.bits=to_bits(flags)
+
+    @property
+    def stats(self):
+        '''Domain stats for this proxy. Dict by domain'''
+        if self._stats is None: self._stats={}
+        return self._stats
+
+    @stats.setter
+    def stats(self, stats):
+        self._stats=stats
+
+    @property
+    def has_stats(self):
+        return bool(self._stats)
+
+    def domain_stats(self, domain):
+        '''The stats for the domain, None if there are none. Doesn't create the dict.'''
+        return self._stats.get(domain) if self._stats else None
+
     def change_flags(self, add, remove):
         '''Add some flags, remove some flags'''
-        self.flags=''.join(sorted((set(self.flags)|set(add))-set(remove)))
+        self.bits=(self.bits|to_bits(add)) & ~to_bits(remove)
         
     def __repr__(self):
         return '{0.p} ({0.flags} {0.tries})'.format(self)
 
+    @classmethod
+    def restore(cls, p, creds=None, flags=''):
+        '''The proxy as it was saved, p is normalised already so it's not parsed again'''
+        res=cls('', flags)
+        res.p=p
+        res.creds=creds
+        return res
+
+def read_tsv(fn):
+    '''Generates the proxies from the TSV file written by proxypool.write(), nothing if there's no such file'''
+    with suppress(FileNotFoundError), open(fn) as f:
+        now=time()
+        for row in reader(f, delimiter='\t'): # (proxy, status, time[, opens, wake_time])
+            p=proxy(row[0], row[1] if len(row) > 1 else '')
+            if len(row) > 2:
+                with suppress(ValueError): p.time=float(row[2])
+            if len(row) > 4 and row[3]: # Circuit breaker state
+                p.opens=int(row[3])
+                if row[4] and float(row[4]) > now: # Still open
+                    p.wake_time=float(row[4])
+                    p.change_flags('C', '')
+            yield p
+
+def tsv_line(p, pf):
+    '''The line of the TSV file for the proxy, with the flags in pf only'''
+    row=[p.p, ''.join(sorted(set(p.flags)&pf)), p.time]
+    if p.opens:
+        row+=[p.opens, p.wake_time if 'C' in p.flags else '']
+    return '\t'.join(map(str, row))+'\n'
+
+class ready_list(OrderedDict):
+    '''The proxies by key in order, that also gives a random key in O(1): the keys are kept in a list too, with their indexes. Deleting swaps the last key into the place.'''
+    def __init__(self):
+        super().__init__()
+        self.keylist=[]
+        self.index={} # Of the key in keylist
+
+    def __setitem__(self, k, v):
+        if k not in self.index:
+            self.index[k]=len(self.keylist)
+            self.keylist.append(k)
+        super().__setitem__(k, v)
+
+    def __delitem__(self, k):
+        super().__delitem__(k)
+        i=self.index.pop(k)
+        last=self.keylist.pop()
+        if last != k:
+            self.keylist[i]=last
+            self.index[last]=i
+
+    def pop(self, k, *default):
+        if k not in self.index:
+            if default: return default[0]
+            raise KeyError(k)
+        v=self[k]
+        del self[k]
+        return v
+
+    def popitem(self, last=True):
+        if not self.index: raise KeyError('popitem(): dictionary is empty')
+        k=next(reversed(self)) if last else next(iter(self))
+        return k, self.pop(k)
+
+    def clear(self):
+        super().clear()
+        self.keylist.clear()
+        self.index.clear()
+
+    def choice(self):
+        '''A random key'''
+        return self.keylist[randrange(len(self.keylist))]
+
 class proxypool:
     '''This class contains a list of proxies, with functions to manipulate this list. With time the list is sorted by usefulness of the proxy: bad proxies go to the end, good proxies stay in the beginning. The access is NOT thread-safe, suitable for aiohttp but the legacy version should use external lock.'''
 
     def update_replenish(self):
         self.replenish_at=datetime.now()+timedelta(seconds=self.replenish_interval)
 
-    def stats(self):
-        #set_trace()
-        return Counter(_.flags for _ in self.master_plist.values())
+    def stats(self, per_domain=False):
+        '''Counts of the proxies by flags. With per_domain set returns proxy_stats summed up across the proxies for every domain instead'''
+        if not per_domain:
+            return Counter(_.flags for _ in self.master_plist.values())
+
+        res={}
+        for p in self.master_plist.values():
+            if not p.has_stats: continue
+            for domain, st in p.stats.items():
+                if domain not in res: res[domain]=proxy_stats()
+                res[domain].merge(st)
+        return res
 
     def load(self, arg):
         '''Always load all proxies, we'll be able to prune and rearrange later
     '''
 
         self.master_plist=OrderedDict()
-        if isinstance(arg, str): # File name    
+        self.dirty=set()
+        if self.store is not None:
+            lg.info('Loading {}'.format(self.store.fn))
+            for p in self.store.load(): self.master_plist[p.p]=p
+            lg.info('Loaded {} {}'.format(self.store.fn, self.stats()))
+        elif isinstance(arg, str): # File name
             lg.info('Loading {}'.format(arg))
-            with suppress(FileNotFoundError), open(arg) as f:
-                rd=reader(f, delimiter='\t')
-                for row in rd: # (proxy, status, time)
-                    p=proxy(row[0], row[1] if len(row) > 1 else '')
-                    self.master_plist[p.p]=p                
+            for p in read_tsv(arg): self.master_plist[p.p]=p
             lg.info('Loaded {} {}'.format(arg, self.stats()))
         else: # Iterable of proxies
             for i in arg:
                 p=proxy(i, 'G') # Mark as good
                 self.master_plist[p.p]=p
             lg.info('Loaded {} proxies from iterable'.format(len(self.master_plist)))
+        self.rebuild()
+
+    def rebuild(self):
+        '''Sorts master_plist into the structures get_proxy() picks from. Must be called after master_plist is replaced or its flags are changed wholesale.
+
+ready: proxies to hand out, best first. in_use: handed out and not returned yet, they are shared when ready runs dry. chilling: heap of (wake_time, seq, proxy). disabled: keys of 'D' and 'B' proxies.
+'''
+        self.ready=ready_list()
+        self.in_use=ready_list() # Becomes ready when that runs dry
+        self.chilling=[]
+        self.disabled=set()
+        for p in self.master_plist.values(): self.admit(p)
+
+    def admit(self, p):
+        '''Puts the proxy to the end of the structure its flags tell'''
+        if p.bits & F_OUT:
+            self.disabled.add(p.p)
+        elif p.bits & F_C and p.wake_time:
+            heappush(self.chilling, (p.wake_time, next(self.seq), p))
+        else:
+            self.ready[p.p]=p
+
+    def withdraw(self, p):
+        '''Removes the proxy from ready and in_use, chilling heap entries are
+dropped lazily when they come up'''
+        self.ready.pop(p.p, None)
+        self.in_use.pop(p.p, None)
+        self.disabled.discard(p.p)
+
+    def wake(self, now=None):
+        '''Moves the proxies whose wake_time has come from the chilling heap to the
+end of ready'''
+        if not self.chilling: return
+        if now is None: now=time()
+        while self.chilling and self.chilling[0][0] <= now:
+            wake_time, dummy, p=heappop(self.chilling)
+            # Stale entry: the proxy was woken up or put to sleep again since
+            if not p.bits & F_C or p.wake_time != wake_time: continue
+            p.wake_time=None
+            p.bits&=~F_C
+            self.ready[p.p]=p
+
+    def next_wake(self):
+        '''Seconds until the first chilling proxy wakes up, None if nobody is chilling'''
+        while self.chilling:
+            wake_time, dummy, p=self.chilling[0]
+            if p.bits & F_C and p.wake_time == wake_time:
+                return max(wake_time-time(), 0)
+            heappop(self.chilling) # Stale entry
+        return None
 
     def __init__(self, arg, max_retries=-1, replenish_interval=None,
-                 replenish_threads=400, no_disable=False):
-        '''Is initialised from arg. It can be iterable, string (treated as filename), or filter instance (to use for the proxies returned by gatherproxy)
+                 replenish_threads=400, no_disable=False, scoring=None,
+                 politeness=None, breaker=None):
+        '''Is initialised from arg. It can be iterable, string (treated as filename: of a proxystore if it ends with .db or .sqlite, of TSV otherwise), proxystore, or filter instance (to use for the proxies returned by gatherproxy)
 If number of errors through the proxy is more than max_retries (and max_retries is not -1), the proxy will be disabled. If arg is None, work without proxy.
 
 If there's only one proxy in the list, it's a special case. We don't disable this proxy.
 replenish_interval: how many seconds must pass between replenishes from gatherproxy.
 replenish_threads: how many threads to use when replenishing (now there's only gatherproxy, so it's a number of threads the farm will use
 no_disable set to True is good for the providers like crawlera or proxyrack, they have one address of the proxy to use, and rotate proxies behind the scene.
+scoring: None to pick proxies in the list order, or an object like ewma_scoring, picking by the stats for the domain passed to get_proxy().
+politeness: rate limits for the domains, see the politeness class.
+breaker: a circuit_breaker to put the failing proxies to rest with growing cooldowns instead of disabling them.
 '''
         self.max_retries=max_retries
         self.retry_no=0 # Retries of the disabled pool
@@ -120,12 +532,24 @@ no_disable set to True is good for the providers like crawlera or proxyrack, the
         self.replenish_interval=replenish_interval
         self.replenish_threads=replenish_threads
         self.no_disable=no_disable
+        self.scoring=scoring
+        self.politeness=politeness
+        self.breaker=breaker
+        self.store=None
+        if isinstance(arg, str) and arg.endswith(('.db', '.sqlite')):
+            from .proxystore import proxystore # It imports this module
+            self.store=proxystore(arg)
+        elif type(arg).__name__ == 'proxystore':
+            self.store=arg
+        self.dirty=set() # Keys of the proxies changed since the last write()
+        self.seq=count() # Tie breaker for the chilling heap
 
         if type(arg).__name__ == 'filter': # Ugly! But cannot import filter because of circular dependency
             self.has_filter=True
             self.replenish_at=datetime.now()
             self.retry_no=self.max_retries # To make it replenish right away
             self.master_plist=OrderedDict()
+            self.rebuild()
         else: # It's an iterable or a file name
             self.load(arg)
 
@@ -146,7 +570,7 @@ If st is None, it will put it into end of the list (to be unlikely picked by the
 
 If st is 'P', prove the proxy. This proxy was ok to download through, set its flags as proven in master_plist. Move it closer to the head to be picked with priority.
 
-If st is 'D', disable the proxy.
+If st is 'D', disable the proxy. With the breaker set, its circuit is opened instead, and any failure of a half-open proxy opens it again.
 
 args vary depending on st. If it's chillout, the arg must be the time to wake up.
         '''
@@ -156,34 +580,65 @@ args vary depending on st. If it's chillout, the arg must be the time to wake up
         # Possible conversion from str to proxy (scrapy middleware)
         # TODO: not needed, middleware does it
         if not isinstance(p, proxy): p=self.master_plist[p]
+        self.dirty.add(p.p)
                 
         if not st:
             lg.debug('downvoting {}'.format(p))
             # We could have had replenish in between, so it's not there
-            with suppress(KeyError): self.master_plist.move_to_end(p)
-            p.change_flags('', 'P') # Remove proven flag
+            with suppress(KeyError): self.master_plist.move_to_end(p.p)
+            p.bits&=~F_P # Remove proven flag
             p.tries+=1
-            #set_trace()
-            if self.max_retries != -1 and p.tries >= self.max_retries:
-                set_trace()
+            if self.breaker and p.opens and not p.bits & F_C:
+                st='D' # Half-open, the trial has failed
+            elif self.max_retries != -1 and p.tries >= self.max_retries:
                 st='D'
+            else: # Still usable, but picked last
+                self.in_use.pop(p.p, None)
+                self.ready[p.p]=p
+                self.ready.move_to_end(p.p)
         elif st == 'P':
             p.tries=0 # Reset the tries counter
-            if 'P' in p.flags: return # Already proven, no fuss
+            if p.opens:
+                lg.info('Closing the circuit of {}'.format(p))
+                p.opens=0
+            if p.bits & F_P: return # Already proven, no fuss
             
             self.master_plist[p.p]=p # It works in any case, don't lose it
             self.master_plist.move_to_end(p.p, False) # Move to the beginning
-            p.change_flags('P','D') # Proxy's in line again!
+            self.disabled.discard(p.p)
+            p.bits=(p.bits|F_P) & ~F_D # Proxy's in line again!
         elif st == 'C':
-            p.wake_time=args[0]
-            p.change_flags('C', '')
+            self.chill(p, args[0])
+
+        if st == 'D' and self.breaker and not self.no_disable:
+            if p.opens and p.bits & F_C:
+                # Open already, a late failure of a request that was made
+                # through it before (say, it was shared from in_use)
+                self.in_use.pop(p.p, None)
+                return
+            p.opens+=1
+            if not self.breaker.max_opens or p.opens <= self.breaker.max_opens:
+                cooldown=self.breaker.cooldown(p.opens)
+                lg.info('Opening the circuit of {} for {:.0f}s'.format(
+                    p, cooldown))
+                p.tries=0
+                self.chill(p, time()+cooldown)
+                return
 
         if st == 'D':
-            # TODO: maybe put it to rest?
-            if not self.no_disable: p.change_flags('D', '')
+            self.withdraw(p)
+            if not self.no_disable: p.bits|=F_D
+            self.admit(p)
             
         #lg.debug('master_plist: {}'.format(self.master_plist))
                 
+    def chill(self, p, wake_time):
+        '''Puts the proxy to rest until wake_time'''
+        p.wake_time=wake_time
+        p.bits|=F_C
+        self.withdraw(p)
+        heappush(self.chilling, (p.wake_time, next(self.seq), p))
+
     def release_proxy(self, p):
         '''Returns the proxy back to the list. Good warm proxy, to be picked by
         next get_proxy().
@@ -194,98 +649,87 @@ args vary depending on st. If it's chillout, the arg must be the time to wake up
         except:
             # Strange error, happens on shutdown. Maybe lg is done with already?
             lg.exception('release_proxy')
-            
-        if self.plist:
-            self.plist[p.p]=p
-            self.plist.move_to_end(p.p, False) # Move to the beginning
 
-    def get_proxy(self, random=False) -> 'proxy':
-        '''Gets proxy from the beginning of the list. In fact we have two lists, one is master_list, all proxies that were read on initialisation, and working list, where we pluck the proxies from. When working list becomes empty, we replenish it again from the master_list.
+        self.in_use.pop(p.p, None)
+        if p.bits & (F_OUT|F_C): return
+        self.ready[p.p]=p
+        self.ready.move_to_end(p.p, False) # Move to the beginning
+
+    def get_proxy(self, random=False, domain=None) -> 'proxy':
+        '''Gets proxy from the beginning of the ready list. All proxies that were read on initialisation are in master_list, the ones we can hand out right now are in ready. Chilling proxies come back to ready when they wake up, and when ready is empty, the proxies that are in use are shared again.
 Set random to True to get random proxy from the available proxies. 
+domain is the host we're going to, with scoring set the proxy is picked by its stats for the domain, and with politeness set the proxies that may go there right now are preferred.
+If all the usable proxies are chilling, ChillingException tells how long to wait, see get_proxy_async() and the threaded proxypool, they wait themselves.
 '''
-        def replenish(self):
-            '''Replenish plist from master_plist. Several cases here'''
-
-            #set_trace()
-            #active_num=self.active_number()
-            #if not active_num and self.flt:
-            if False: #  self.has_filter: # Doesn't work for now
-                # First check if we have something in the disabled pool, we'll put them back into the main pool (master_plist) and see if they have repented. Up to max_retries times, otherwise they burn in hell.                
-                if datetime.now() < self.replenish_at: #self.retry_no < self.max_retries:
-                    if len(self.disabled):
-                        lg.info('Putting back disabled set into master_plist')
-                        self.master_plist=list(self.disabled|set(self.master_plist))
-                        self.retry_no+=1
-                else:
-                    # Squash and then restore the farm messages
-                    while True:
-                        try:
-                            gp_lst=self.gatherproxy()
-                        except Exception as e:
-                            #lg.warning('Exception in gatherproxy')
-                            lg.exception('Exception in gatherproxy')
-                            continue
-                        if gp_lst is None:
-                            lg.warning('Error in gatherproxy')
-                            continue
-                        break
-                            
-                    lg.warning('Filtering gp data: {}'.format(len(gp_lst)))
-                    retr_lg=getLogger('retr.farm')
-                    old_level=retr_lg.getEffectiveLevel()
-                    retr_lg.setLevel(ERROR)
-
-                    self.master_plist=list(map(proxy, self.arg.get_good(gp_lst, self.replenish_threads)))
-                    self.disabled=set()
-                    retr_lg.setLevel(old_level)
-                    self.update_replenish()
-                    #lg.warning('Finished replenishment: {} {} {}'.format(len(self.master_plist), len(self.disabled), len(self.plist)))
-
-            self.plist=self.master_plist.copy()
-            if len(self.master_plist) > 1: # Don't spam with trivial cases
-                lg.info('Replenished from master_plist {}.'.format(self.stats()))
-            
-        p=None
-        #lg.debug( 'self.plist: {}'.format(len(self.plist) or 'Empty'))
-        #lg.error('get_proxy: pp={}, plist={}, master_plist={}'.format(self, self.plist, self.master_plist))
-        #lg.error('get_proxy: pp={}, master_plist={}'.format(self, self.master_plist))
         while True:
-            
-            try:
-                if random:
-                    proxy = choice(tuple(self.plist.keys()))
-                    del plist[proxy]
-                else:
-                    dummy,p=self.plist.popitem(False) # Get from the beginning
-                    if 'D' in p.flags:
-                        pass #lg.error('Got disabled proxy')
-                    elif 'B' in p.flags:
-                        pass # lg.warning('Got bad proxy')
-                    elif 'C' in p.flags:
-                        if p.wake_time and time() >= p.wake_time:
-                            p.wake_time=None
-                            p.change_flags('', 'C')
-                            break
-                        else:
-                            lg.debug('The proxy is sleeping')
-                    else:
-                        break
+            self.wake()
+            if not self.ready:
+                if self.in_use: # Share the proxies already handed out
+                    self.ready, self.in_use=self.in_use, self.ready
+                    lg.debug('Replenished from in_use: {}'.format(
+                        len(self.ready)))
                     continue
-            except (KeyError, AttributeError):
-                if not len(self.master_plist) and not self.has_filter:
-                    raise NoProxiesException
-                if not any(
-                        filter(lambda v: 'D' not in v.flags,
-                               self.master_plist.values())):
-                    raise NoProxiesException # All are disabled
-                replenish(self) # Local function
+                delay=self.next_wake()
+                if delay is not None:
+                    lg.debug('The proxies are sleeping: {:.1f}s'.format(delay))
+                    raise ChillingException(delay)
+                raise NoProxiesException # Nothing, or all are disabled
+
+            if random:
+                p=self.ready.pop(self.ready.choice())
+            elif domain and (self.scoring or self.politeness):
+                p=self.pick(domain)
+            else:
+                dummy,p=self.ready.popitem(False) # Get from the beginning
+
+            # The flags may have been changed behind our back
+            if p.bits & F_OUT:
+                self.disabled.add(p.p)
                 continue
-            # TODO
-            # if 'C' in p.flags and ...:
-            #    continue # Skip it
-            break
+            if p.bits & F_C:
+                if p.wake_time and time() < p.wake_time:
+                    self.admit(p) # Back to the heap
+                    continue
+                p.wake_time=None
+                p.bits&=~F_C
+            
+            self.in_use[p.p]=p
+            return p
+
+    def pick(self, domain):
+        '''Takes the proxy for the domain out of the first ones in ready: among the ones the politeness allows to go right now, the best by the scoring'''
+        sample=(self.scoring or self.politeness).sample
+        candidates=tuple(islice(self.ready.values(), sample))
+        if self.politeness:
+            now=time()
+            candidates=tuple(
+                _ for _ in candidates
+                if self.politeness.allowed(_, domain, now)) or candidates
+        p=self.scoring.pick(candidates, domain) if self.scoring \
+            else candidates[0]
+        del self.ready[p.p]
         return p
 
+    def throttle(self, p, domain):
+        '''To be called before every request through the proxy to the domain. Returns 0 if it may go right now, otherwise how many seconds to wait before asking again'''
+        if not self.politeness or not domain: return 0
+        return self.politeness.take(p, domain, time())
+
+    def record(self, p, domain, start, latency=None, ok=True):
+        '''Updates the stats of the proxy for the domain, see proxy_stats.update()'''
+        if domain not in p.stats:
+            p.stats[domain]=proxy_stats()
+        p.stats[domain].update(start, latency, ok)
+        self.dirty.add(p.p)
+
+    async def get_proxy_async(self, *args, **kwargs) -> 'proxy':
+        '''get_proxy() that awaits for the chilling proxies to wake up instead of raising'''
+        while True:
+            try:
+                return self.get_proxy(*args, **kwargs)
+            except ChillingException as e:
+                await sleep(e.args[0])
+
     def gatherproxy(self):
         lg.info('Getting from gatherproxy.com')
 
@@ -323,26 +767,94 @@ Set random to True to get random proxy from the available proxies.
         
         return r.text.splitlines()
             
+    def partition(self, n, num):
+        '''Keeps only every num-th proxy starting from n-th, for the process n out of num to have its own part of the pool. If there are fewer proxies than num, they're all kept.'''
+        if len(self.master_plist) < num: return
+        self.master_plist=OrderedDict(islice(self.master_plist.items(),
+                                             n, None, num))
+        self.rebuild()
+
+    def snapshot(self):
+        '''State of the proxies, to be applied to another pool with apply()'''
+        return {k: (v.bits, v.tries, v.wake_time, v.opens)
+                for k, v in self.master_plist.items()}
+
+    def apply(self, state):
+        '''Sets the state of the proxies we have from snapshot() of another pool'''
+        for k, (bits, tries, wake_time, opens) in state.items():
+            p=self.master_plist.get(k)
+            if not p: continue
+            self.dirty.add(k)
+            p.tries=tries
+            p.opens=opens
+            if (bits, wake_time) == (p.bits, p.wake_time): continue
+            p.bits=bits
+            p.wake_time=wake_time
+            self.withdraw(p)
+            self.admit(p)
+
+    def mark(self, p, flag, latency=None):
+        '''Sets the verdict of a filter on the proxy: 'G', 'B' or 'D', dropping the other ones and 'O'. latency (seconds) goes to p.time. Good proxies are moved to the beginning of master_plist.'''
+        p.change_flags(flag, 'GBDO'.replace(flag, ''))
+        self.dirty.add(p.p)
+        if latency is not None: p.time=latency
+        if flag == 'G':
+            p.tries=0
+            p.opens=0
+            with suppress(KeyError): self.master_plist.move_to_end(p.p, False)
+        self.withdraw(p)
+        self.admit(p)
+
+    def revive(self, p, latency=None):
+        '''Puts a disabled or bad proxy back into rotation as good, say when it has passed a check'''
+        lg.info('Reviving {}'.format(p))
+        self.mark(p, 'G', latency)
+
+    def sidelined(self):
+        '''The proxies out of rotation: disabled and bad'''
+        return [self.master_plist[k] for k in self.disabled
+                if k in self.master_plist]
+
     def write(self, preserve_flags='DG'):
         '''Write master proxy list to a file. New file will be created with the same
 order as in master list, good proxies first, bad last. So it's advised to run it
 before the program exit, for proxies to be sorted in better order.
 
-We can set the flags to preserve with preserve_flags parameter.
+We can set the flags to preserve with preserve_flags parameter. The proxies with their circuit open or half-open (see circuit_breaker) get two more columns: the number of openings and the wake time.
 
+With a proxystore only the proxies changed since the last write() are saved, with all their state and flags but 'O', preserve_flags is for TSV.
         '''
-        if not self.arg or type(self.arg) is not str: return
-        
+        rows=self.rows(preserve_flags)
+        try:
+            self.save(rows)
+        except BaseException:
+            self.unsaved(rows)
+            raise
+
+    def rows(self, preserve_flags='DG'):
+        '''What write() saves, taken from the pool quickly: the changed proxies for the store, the lines for TSV, None if there's nowhere to write'''
+        if self.store is not None:
+            dirty, self.dirty=self.dirty, set()
+            return [self.store.row(self.master_plist[k]) for k in dirty
+                    if k in self.master_plist]
+        if not self.arg or type(self.arg) is not str: return None
+        pf=set(preserve_flags)
+        # Put proven first
+        return [tsv_line(v, pf) for v in sorted(
+            self.master_plist.values(), key=lambda _: bool(_.bits & F_P))]
+
+    def unsaved(self, rows):
+        '''Marks the proxies of the rows the store has failed to save as changed again, so the next write() saves them'''
+        if self.store is not None and rows: self.dirty.update(_[0] for _ in rows)
+
+    def save(self, rows):
+        '''Writes rows() out, doesn't touch the pool'''
+        if rows is None: return
+        if self.store is not None:
+            self.store.save(rows)
+            return
         lg.info('Writing new proxies to: '+self.arg)
-        with open(self.arg, 'w') as f:
-            # Put proven first
-            #set_trace()
-            pf=set(preserve_flags)
-            for k, v in sorted(self.master_plist.items(),
-                               key=lambda _: 'P' in _[1].flags):
-                # Filter the flags
-                f.write('{}\t{}\t{}\n'.format(
-                    v.p, ''.join(sorted(set(v.flags)&pf)), v.time))
+        with open(self.arg, 'w') as f: f.writelines(rows)
 
     # Several useful functions for filtering
     def set_plist_for_filter(self, verbatim=False):
@@ -371,6 +883,8 @@ We can set the flags to preserve with preserve_flags parameter.
         self.old_master_plist, self.master_plist=self.master_plist, new_plist
 
         for v in self.master_plist.values(): v.change_flags('O', 'BG')
+        self.dirty.update(self.master_plist)
+        self.rebuild()
 
         self.length=0
         if len(self.master_plist) > 5000:
@@ -383,6 +897,7 @@ We can set the flags to preserve with preserve_flags parameter.
     def update_master(self):
         self.old_master_plist.update(self.master_plist) # Maybe flags have changed?
         self.master_plist=self.old_master_plist
+        self.rebuild()
 
     def print_length(self):
         '''Increments the counter and outputs at step values'''
@@ -0,0 +1,115 @@
+'''Proxies of a proxypool in one SQLite file, instead of the TSV one.
+
+pp=proxypool('proxies.db') # Or proxypool(proxystore('proxies.db'))
+...
+pp.write() # Saves only the proxies changed since the last write()
+
+The rows are normalised already, so loading doesn't parse the proxies again,
+and write() takes the lock of the pool only to copy the changed ones. Everything
+of a proxy is kept: flags, tries, the last latency (p.time), the circuit breaker
+state and the stats per domain. TSV goes in and out with import_tsv() and
+export_tsv().
+'''
+
+from threading import Lock
+from json import dumps, loads
+from time import time
+from logging import getLogger
+import sqlite3
+
+from .proxypool_common import proxy, proxy_stats, read_tsv, tsv_line
+
+lg=getLogger(__name__)
+
+class proxystore:
+    '''Thread-safe. The proxies are loaded good first: proven, good, not yet
+known, bad and disabled, in the order they came within each.'''
+    def __init__(self, fn):
+        self.fn=fn
+        self.lock=Lock()
+        self.db=sqlite3.connect(fn, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS proxies (
+            p TEXT PRIMARY KEY, creds TEXT, flags TEXT, tries INTEGER,
+            time REAL, opens INTEGER, wake_time REAL, stats TEXT,
+            rank INTEGER)''')
+
+    @staticmethod
+    def rank(flags):
+        '''Where the proxy goes on load, lower first'''
+        if 'P' in flags: return 0
+        if 'G' in flags: return 1
+        if 'D' in flags or 'B' in flags: return 3
+        return 2
+
+    @staticmethod
+    def row(p):
+        '''A copy of the state of the proxy for save(), quick enough to be taken
+under the lock of the pool: save() does the JSON and the ranks. The 'O' flag is
+for the filter run only, it's not saved.'''
+        stats={k: v.state() for k, v in p.stats.items()} \
+            if p.has_stats else None
+        return (p.p, p.creds, p.flags.replace('O', ''), p.tries, p.time,
+                p.opens, p.wake_time, stats)
+
+    def load(self):
+        '''Generates the proxies'''
+        with self.lock:
+            rows=self.db.execute(
+                'SELECT p, creds, flags, tries, time, opens, wake_time, stats '
+                'FROM proxies ORDER BY rank, rowid').fetchall()
+        now=time()
+        for k, creds, flags, tries, tm, opens, wake_time, stats in rows:
+            p=proxy.restore(k, creds, flags)
+            p.tries=tries
+            p.time=tm
+            p.opens=opens
+            if 'C' in flags:
+                if wake_time and wake_time > now:
+                    p.wake_time=wake_time
+                else: # Has slept it off meanwhile
+                    p.change_flags('', 'C')
+            if stats:
+                p.stats={k: proxy_stats.restore(v)
+                         for k, v in loads(stats).items()}
+            yield p
+
+    def save(self, rows):
+        '''Inserts or updates the rows made by row()'''
+        if not rows: return
+        records=[(k, creds, flags, tries, tm, opens, wake_time,
+                  None if stats is None else
+                  dumps({d: proxy_stats.dump_state(v)
+                         for d, v in stats.items()}),
+                  self.rank(flags))
+                 for k, creds, flags, tries, tm, opens, wake_time, stats in rows]
+        with self.lock, self.db:
+            self.db.executemany(
+                'INSERT INTO proxies VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT(p) DO UPDATE SET creds=excluded.creds, '
+                'flags=excluded.flags, tries=excluded.tries, '
+                'time=excluded.time, opens=excluded.opens, '
+                'wake_time=excluded.wake_time, stats=excluded.stats, '
+                'rank=excluded.rank', records)
+        lg.debug('Saved {} proxies to {}'.format(len(rows), self.fn))
+
+    def import_tsv(self, fn):
+        '''Adds the proxies from the TSV file, the ones already here are updated'''
+        rows=[self.row(p) for p in read_tsv(fn)]
+        self.save(rows)
+        lg.info('Imported {} proxies from {}'.format(len(rows), fn))
+
+    def export_tsv(self, fn, preserve_flags='DG'):
+        '''Writes the proxies to the TSV file like proxypool.write() does'''
+        pf=set(preserve_flags)
+        with open(fn, 'w') as f:
+            for p in self.load(): f.write(tsv_line(p, pf))
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM proxies').fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.db.close()
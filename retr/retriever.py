@@ -9,35 +9,135 @@ r=rtv.request('get', 'www.google.com')
 
 from time import sleep, time
 from contextlib import suppress
+from itertools import chain
+from collections import OrderedDict
+from threading import Lock
 from logging import getLogger
 from pdb import set_trace
 from ssl import SSLError
 from OpenSSL.SSL import Error as openssl_error
-from os import makedirs, path
+from os import makedirs, path, replace, remove
+from urllib.parse import urlsplit
 import urllib3.exceptions as u3_exceptions
 
 from requests import exceptions, Session, Request
 from requests.adapters import HTTPAdapter
 from requests.utils import cookiejar_from_dict
-from requests.packages.urllib3.poolmanager import ProxyManager
+from requests.packages.urllib3.poolmanager import PoolManager, ProxyManager
 from requests.packages.urllib3.exceptions import LocationParseError
 
-from . import ValidateException
+from .cache import pagecache, dircache
+from . import ValidateException, BodyTooLargeException
 
 lg=getLogger(__name__)
 
+files=dircache() # The cache for the pages when cache is just true
+
+class pm_cache:
+    '''Keep-alive connection managers by proxy, shared by all the retrievers in the process, so switching to a proxy used before gets warm sockets. The least recently used managers are dropped when there are more than size of them, and the ones not used for idle_timeout seconds; they're closed once no session has them mounted. maxsize is the number of connections kept per host (and proxy).'''
+    def __init__(self, size=1000, idle_timeout=300, maxsize=10, num_pools=10):
+        self.size=size
+        self.idle_timeout=idle_timeout
+        self.maxsize=maxsize
+        self.num_pools=num_pools
+        self.lock=Lock()
+        self.pms=OrderedDict() # (pm, last used) by key, least recent first
+        self.mounted={} # Number of the adapters by pm
+        self.evicted=set() # Dropped from pms, but still mounted
+
+    @staticmethod
+    def key(p, proxy_headers=None, ca_certs=None):
+        return (p, tuple(sorted((proxy_headers or {}).items())), ca_certs)
+
+    def get(self, p, proxy_headers=None, timeout=30, ca_certs=None, mount=False):
+        '''p is the proxy URL, '' for direct connections. With mount set the manager is counted as mounted, until unmount().'''
+        key=self.key(p, proxy_headers, ca_certs)
+        now=time()
+        with self.lock:
+            try:
+                pm,dummy=self.pms.pop(key)
+            except KeyError:
+                if p:
+                    pm=ProxyManager(p, num_pools=self.num_pools,
+                                    timeout=timeout, proxy_headers=proxy_headers,
+                                    ca_certs=ca_certs, maxsize=self.maxsize)
+                else:
+                    pm=PoolManager(num_pools=self.num_pools, timeout=timeout,
+                                   ca_certs=ca_certs, maxsize=self.maxsize)
+            self.pms[key]=(pm, now) # To the end, most recent
+            if mount: self.mounted[pm]=self.mounted.get(pm, 0)+1
+
+            # Drop the idle ones and the excess
+            while self.pms:
+                k,(old_pm, last)=next(iter(self.pms.items()))
+                if len(self.pms) <= self.size and now-last < self.idle_timeout:
+                    break
+                del self.pms[k]
+                if old_pm in self.mounted: # Close it when it's unmounted
+                    self.evicted.add(old_pm)
+                else:
+                    old_pm.clear()
+        return pm
+
+    def unmount(self, pm):
+        '''An adapter with the manager is closed, the manager is closed too if it's been dropped and it was the last one'''
+        with self.lock:
+            n=self.mounted.pop(pm, 0)-1
+            if n > 0:
+                self.mounted[pm]=n
+            elif pm in self.evicted:
+                self.evicted.discard(pm)
+                pm.clear()
+
+    def touch(self, key):
+        '''Marks the manager as just used, the adapters call it on every request so the managers in use are not closed as idle'''
+        with self.lock:
+            with suppress(KeyError):
+                pm,dummy=self.pms[key]
+                self.pms[key]=(pm, time())
+                self.pms.move_to_end(key)
+
+    def adapter(self, p, proxy_headers=None, timeout=30, ca_certs=None,
+                max_retries=0):
+        '''The adapter to mount on a session, with the manager from get()'''
+        pm=self.get(p, proxy_headers, timeout, ca_certs, mount=True)
+        return _adapter(pm, max_retries, self, self.key(p, proxy_headers,
+                                                          ca_certs))
+
+    def clear(self):
+        '''Closes all the managers, mounted or not'''
+        with self.lock:
+            for pm,dummy in self.pms.values(): pm.clear()
+            for pm in self.evicted: pm.clear()
+            self.pms.clear()
+            self.evicted.clear()
+
+shared_pms=pm_cache() # Default one for the process
+
 class _adapter(HTTPAdapter):
-    def __init__(self, p, proxy_headers={}, timeout=30,
-                 max_retries=0, ca_certs=False):
+    '''Uses the connection manager from pm_cache, for the proxy or direct
+connections'''
+    def __init__(self, pm, max_retries=0, pms=None, key=None):
         super().__init__(max_retries=max_retries, # This one is the main value
-                         pool_connections=10,
-                         pool_maxsize=1, pool_block=True)
-        self.pm=ProxyManager(p, num_pools=10, timeout=timeout, # retries=2, #max_retries,
-                             proxy_headers=proxy_headers,  
-                             ca_certs=ca_certs)
+                         pool_connections=1, pool_maxsize=1)
+        self.pm=pm
+        self.pms=pms # The pm_cache to tell it's still used
+        self.key=key
+        self.mounted=pms is not None # Till close(), it's called once per mount
+        if not isinstance(pm, ProxyManager): self.poolmanager=pm
+
+    def send(self, *args, **kwargs):
+        if self.pms: self.pms.touch(self.key)
+        return super().send(*args, **kwargs)
 
     def proxy_manager_for(self, proxy, **proxy_kwargs):
         return self.pm
+
+    def close(self):
+        '''The managers are shared, pm_cache closes them when they're unmounted'''
+        if self.mounted:
+            self.mounted=False
+            self.pms.unmount(self.pm)
         
 # Has its own Session object
 class retriever:
@@ -51,11 +151,12 @@ class retriever:
     # 'Accept-Encoding': 'gzip, deflate, sdch'
     def __init__(self, pp, proxy_headers={},
                  max_retries=0, timeout=60, ca_certs=None,
-                 discard_timeout=False):
+                 discard_timeout=False, pms=None):
         '''pp - proxypool to use
 max_retries and timeout - the same as in requests.Session.
 
 discard_timeout set to True will discard timed out proxies. Should have some sort of refresh, or we'll run out of proxies
+pms - pm_cache to take the connections from, shared_pms by default
 '''
         self.pp = pp # Proxypool
         self.p = None
@@ -66,14 +167,21 @@ discard_timeout set to True will discard timed out proxies. Should have some sor
         self.discard_timeout=discard_timeout
         self.ca_certs=ca_certs
         self.s=None
+        self.pms=pms or shared_pms
         self.quit_flag=False # Set to True from outside to make thread quit
         self.f=None # To be filled by the farm, backlink to the farm object
         
     def __del__(self):        
         if self.p: # Leave this good proxy for someone to use
             self.pp.release_proxy(self.p)
+        if self.s: self.s.close() # Unmounts the connection manager
         del self.s
         
+    def report(self, latency=None, ok=True, chilled=False):
+        '''Tells the controller of the farm how the request went, if there's one'''
+        c=getattr(self.f, 'controller', None)
+        if c: c.report(latency, ok, chilled)
+
     def change_proxy(self, err, status=None, *args):
         '''Change proxy, optionally changing its status. The reason might have been that it was
 bad or something, put it to the end of the list or mark as disabled.
@@ -87,20 +195,20 @@ bad or something, put it to the end of the list or mark as disabled.
         self.pp.set_status(self.p, status, *args)
         self.p=None # Will pick new proxy on next download
 
-    def pick_proxy(self, regular=False):
+    def pick_proxy(self, regular=False, domain=None):
         '''Pick proxy manually, may be needed for cases like visa, where we need to know
         our IP to put into the requests.
-
+domain is passed to the proxypool to pick the proxy by its stats, if it does scoring.
         '''
 
         if self.p is not None: return
         
-        self.p=self.pp.get_proxy()
+        self.p=self.pp.get_proxy(domain=domain)
         lg.debug("proxy: {}".format(self.p))
         
-        # As we're based on the requests.Session, which in turn has
-        # connectionpool and persistent connections, remove previous
-        # session and make a totally new one to be safe.
+        # Make a new session to start with clean cookies and state for the
+        # proxy. The connections are not its own though, they're kept warm in
+        # pm_cache.
         if self.s:
             self.s.close()
             del self.s
@@ -108,37 +216,69 @@ bad or something, put it to the end of the list or mark as disabled.
         # I cannot make it work unless set the headers here. No idea why.
         if self.p.p: # Only if we have some proxy            
             self.proxy_headers={'Proxy-Authorization': self.p.creds} if self.p.creds else None            
-            a=_adapter(self.p.p, self.proxy_headers,
-                       self.timeout, self.max_retries, self.ca_certs)
-            self.s.mount('http://', a)
-            self.s.mount('https://', a)
+        a=self.pms.adapter(self.p.p, self.proxy_headers if self.p.p else None,
+                           self.timeout, self.ca_certs, self.max_retries)
+        self.s.mount('http://', a)
+        self.s.mount('https://', a)
         if regular: self.setup_session()
 
     def cached(self, fn, what, binary, *args, **kwargs):
-        '''Expects do_filter and cache members'''
-        try:
-            if self.do_filter: raise FileNotFoundError
-            if self.cache:
-                # Only create intermediate dirs if we use cache
-                makedirs(path.dirname(fn), exist_ok=True)
-                with open(fn, 'rb' if binary else 'r') as ff: text=ff.read()
-            else:
-                raise FileNotFoundError # Fire artificially to retrieve the page
+        '''Expects do_filter and cache members. cache can be a pagecache (see retr.cache) to keep the pages in, fn is the key then. Otherwise if cache is true, pages are kept in the files named fn.'''
+        store=None
+        if not self.do_filter and self.cache:
+            store=self.cache if isinstance(self.cache, pagecache) else files
+        data=store.get(fn) if store else None
+        if data is not None:
             lg.debug('Found {}: {}'.format(what, fn))
-            cached=True
-        except:
-            lg.debug('Getting {}'.format(what))
-            r=self.request(*args, **kwargs)
-            text=r.content if binary else r.text 
-            if self.cache:
-                if binary:
-                    open_args={'mode': 'wb'}
-                else:
-                    open_args={'mode': 'w', 'encoding': 'utf8'}
-                with open(fn,  **open_args) as ff: ff.write(text)
-            cached=False
-        
-        return text, cached
+            return (data if binary else data.decode('utf8')), True
+
+        lg.debug('Getting {}'.format(what))
+        r=self.request(*args, **kwargs)
+        text=r.content if binary else r.text 
+        if store: store.put(fn, text if binary else text.encode('utf8'))
+        return text, False
+
+    def cached_file(self, fn, what, *args, chunk_size=1<<16, **kwargs):
+        '''Like cached(), but the body is streamed right into the file fn, it's never held in memory. Returns (fn, cached). kwargs go to stream(), so peek and max_size can be set.'''
+        with suppress(AttributeError): # If we don't have do_filter or cache
+            if not self.do_filter and self.cache and path.exists(fn):
+                lg.debug('Found {}: {}'.format(what, fn))
+                return fn, True
+
+        lg.debug('Getting {}'.format(what))
+        makedirs(path.dirname(fn), exist_ok=True)
+        # Under another name until it's complete
+        try:
+            with open(fn+'.part', 'wb') as ff:
+                for chunk in self.stream(*args, chunk_size=chunk_size, **kwargs):
+                    ff.write(chunk)
+        except BaseException: # Don't leave the partial body behind
+            with suppress(FileNotFoundError): remove(fn+'.part')
+            raise
+        replace(fn+'.part', fn)
+        return fn, False
+
+    def stream(self, what, url, chunk_size=1<<16, peek=0, max_size=None,
+               **params):
+        '''Generator of the response body chunks, the arguments are the same as in request(). The body is not held in memory.
+
+peek: that many first bytes of the body are read before validate() is called, which finds them in r.head.
+max_size: BodyTooLargeException is raised if the body turns out to be bigger.
+
+Proxy errors while the body is being read are not retried, it's too late.'''
+        r=self.request(what, url, stream=True, peek=peek, **params)
+        try:
+            if max_size and \
+               int(r.headers.get('Content-Length', 0)) > max_size:
+                raise BodyTooLargeException(url)
+            size=0
+            for chunk in chain((r.head,), r.iter_content(chunk_size)):
+                size+=len(chunk)
+                if max_size and size > max_size:
+                    raise BodyTooLargeException(url)
+                if chunk: yield chunk
+        finally:
+            r.close()
 
     def clear_cookies(self):
         '''Clear the session cookies'''
@@ -152,6 +292,7 @@ example, requiring authorisation at the proxy, or telling we're over the limit.
 This function validates the page, for example, looking for anchors. Basic
 function checks only for status code. To signal some unusual condition, raise a ValidateException (see the doc)
 This function may be superseded in the descendant.
+When the body is streamed, only its beginning is available in r.head (see stream()).
 
         '''
         if r.status_code in [200, 301]: return
@@ -163,11 +304,12 @@ This function may be superseded in the descendant.
         '''To be implemented in the descendant class. Call it to update the prepared request used within the request() cycle. For example setup_session may return some token to be used in subsequent calls'''
         pass
     
-    def request(self, what, url, regular=True, **params):
+    def request(self, what, url, regular=True, stream=False, peek=0, **params):
         '''Downloads individual URL, the signature is more or less the same as in Session.request(). It manages proxies within the proxypool depending on the request outcome.
 
 Setting regular to False is used in setup_session (to evade calling setup_session() ad inf., and for other things that differ)
 
+stream set to True leaves the body unread, except for peek first bytes, which are put to r.head for validate(). See stream().
         '''
         r = None # r will live on this level
         retry=0 # For chunked retries
@@ -181,6 +323,7 @@ Setting regular to False is used in setup_session (to evade calling setup_sessio
 
         # NB: headers, if present in the request args, is passed here
         req = Request(what, url, **params)
+        host=urlsplit(url).hostname # For the proxy stats
 
         while True:
             #print(self.quit_flag)
@@ -191,7 +334,7 @@ Setting regular to False is used in setup_session (to evade calling setup_sessio
             args=[] # Additional args for the proxy
             
             #lg.info('New run')
-            self.pick_proxy(regular) # This will eventually call setup_session()
+            self.pick_proxy(regular, host) # This will eventually call setup_session()
 
             self.update_request(req, regular)
             # In case they were set in setup_session()
@@ -199,7 +342,14 @@ Setting regular to False is used in setup_session (to evade calling setup_sessio
             prepped.headers.update(self.headers)
             prepped.headers.update(request_headers)
 
+            # Politeness, if the proxypool has rate limits for the host
+            while True:
+                delay=self.pp.throttle(self.p, host)
+                if not delay: break
+                sleep(delay)
+
             err=""
+            time_start=time()
             try:
                 proxies={'https': self.p.p, 'http': self.p.p} if self.p else {}
                 #lg.debug( 'Before request: {} {}'.format(what, url) )
@@ -207,15 +357,18 @@ Setting regular to False is used in setup_session (to evade calling setup_sessio
                 # params['headers']['User-Agent']=self.ua.ff
                 # sleep(10)
 
-                time_start=time()
                 r = self.s.send(prepped, proxies=proxies,
                                 verify=self.ca_certs, timeout=self.timeout,
-                                allow_redirects=allow_redirects)
+                                allow_redirects=allow_redirects, stream=stream)
+                if stream: r.head=r.raw.read(peek, decode_content=True) \
+                   if peek else b''
                 #lg.debug( 'After request: {} {}'.format(what, url) )
                 #print(r.text)
                 self.validate(url, r)
                 self.pp.set_status( self.p, 'P' ) # Mark proxy as working
                 self.p.time=time()-time_start
+                self.pp.record(self.p, host, time_start, self.p.time)
+                self.report(self.p.time)
                 return r
             except exceptions.ChunkedEncodingError:
                 err="chunked" # Fail otherwise
@@ -285,6 +438,8 @@ Setting regular to False is used in setup_session (to evade calling setup_sessio
                 err=type(e)
 
             # Sometimes r is not bound on return from the function.
+            with suppress(UnboundLocalError, AttributeError):
+                if stream: r.close() # Give the connection back
             with suppress(UnboundLocalError): del r
             
             #lg.info( 'After try: {} {} {} {}'.format(what, url, err, status) )
@@ -304,4 +459,6 @@ Setting regular to False is used in setup_session (to evade calling setup_sessio
                 #set_trace()
                 raise ProxyException(self.p.p)
 
+            if self.p: self.pp.record(self.p, host, time_start, ok=False)
+            self.report(ok=False, chilled=status == 'C')
             self.change_proxy(err, status, *args)
@@ -11,23 +11,74 @@ TODO: update
 #from time import sleep
 from contextlib import suppress
 from logging import getLogger
-from aiohttp import ClientSession, \
+from aiohttp import ClientSession, TCPConnector, \
     ClientConnectorError, ClientResponseError, ClientOSError, \
     ClientHttpProxyError, ServerDisconnectedError, ClientProxyConnectionError
-from async_timeout import timeout
-from asyncio import TimeoutError as aio_TimeoutError, sleep, Task
-from os import makedirs, path
+from asyncio import TimeoutError as aio_TimeoutError, sleep, current_task, \
+    get_running_loop, IncompleteReadError
+try:
+    from asyncio import timeout
+except ImportError: # Before 3.11
+    from async_timeout import timeout
+from weakref import WeakKeyDictionary
+from os import makedirs, path, replace, remove
+from urllib.parse import urlsplit
+from time import time
 from ssl import SSLError, SSLZeroReturnError, CertificateError
 from pdb import set_trace
 
 from retrying import retry
 
 from .utils import CustomAdapter
-from .proxypool_common import proxy_stats
-from . import ValidateException
+from .cache import pagecache, dircache, aiocache
+from . import ValidateException, BodyTooLargeException
 
 lg=getLogger(__name__)
 #lg=CustomAdapter(lg, {})
+
+files=dircache() # The cache for the pages when cache is just true
+aiocaches={} # aiocache fronts by pagecache outside of the farms, see close_caches()
+
+def cache_front(cache, fronts=aiocaches):
+    '''aiocache for the cache member of the retriever, kept in fronts: the ones
+of its farm, or the ones close_caches() closes'''
+    if isinstance(cache, aiocache): return cache
+    if not isinstance(cache, pagecache): cache=files
+    if cache not in fronts: fronts[cache]=aiocache(cache)
+    return fronts[cache]
+
+async def close_caches():
+    '''Writes out what the caches have queued and drops them. They're kept till
+then, so the retrievers used without a farm should call it in the end.'''
+    for c in list(aiocaches.values()): await c.close()
+    aiocaches.clear()
+
+connectors=WeakKeyDictionary() # Shared (TCPConnector, its kwargs) by event loop
+
+def shared_connector(**kwargs):
+    '''The TCPConnector shared by the retrievers running in the current event loop, across the proxies too. kwargs (limit, limit_per_host etc) go to TCPConnector when it's created, the farm does it first. If it's there already with other kwargs, they're ignored with a warning.'''
+    loop=get_running_loop()
+    c, args=connectors.get(loop, (None, None))
+    if c is None or c.closed:
+        c=TCPConnector(**kwargs)
+        connectors[loop]=(c, kwargs)
+    elif kwargs and kwargs != args:
+        lg.warning('The shared connector has {}, not {}'.format(args, kwargs))
+    return c
+
+def has_connector():
+    '''Whether the current event loop has the shared connector open'''
+    c, dummy=connectors.get(get_running_loop(), (None, None))
+    return c is not None and not c.closed
+
+async def close_connector(c=None):
+    '''Closes c, the shared connector of the current event loop by default'''
+    loop=get_running_loop()
+    shared, dummy=connectors.get(loop, (None, None))
+    if c is None: c=shared
+    if c is None: return
+    if c is shared: del connectors[loop]
+    await c.close()
         
 # Has its own ClientSession object inside
 class retriever:
@@ -39,12 +90,13 @@ class retriever:
     # 'Accept-Encoding': 'gzip, deflate, sdch'
     def __init__(self, pp, headers={}, proxy_headers={},
                  max_retries=0, timeout=60, ca_certs=None,
-                 disable_timeout=False):
+                 disable_timeout=False, connector=None):
         '''pp - proxypool to use
 headers - the headers to use in the underlying requests.Session
 max_retries and timeout - the same as in ClientSession.
 
 disable_timeout set to True will disable timed out proxies. Should have some sort of refresh, or we'll run out of proxies
+connector - TCPConnector to use, shared_connector() by default
 '''
         self.pp = pp # Proxypool
         self.p = None
@@ -55,13 +107,22 @@ disable_timeout set to True will disable timed out proxies. Should have some sor
         self.timeout=timeout
         self.disable_timeout=disable_timeout
         self.ca_certs=ca_certs
+        self.connector=connector
         self.s=None
+        self.f=None # To be filled by the farm, backlink to the farm object
 
     def __del__(self):
         if self.pp and self.p: # Leave this good proxy for someone to use
             self.pp.release_proxy(self.p)
+
+    async def close(self):
+        '''Closes the session (the connector is shared, so it's left open) and releases the proxy'''
         if self.s:
-            self.s.close()
+            await self.s.close()
+            self.s=None
+        if self.pp and self.p:
+            self.pp.release_proxy(self.p)
+            self.p=None
                 
     def __getattr__(self, name):
         '''Prepend name name to standard logger functions'''
@@ -69,9 +130,14 @@ disable_timeout set to True will disable timed out proxies. Should have some sor
         if name in ('debug', 'info', 'warning', 'error', 'exception'):
             # task id by default
             nm=getattr(self, 'name',
-                       '{:04x}'.format(id(Task.current_task())%(1<<16)))
+                       '{:04x}'.format(id(current_task())%(1<<16)))
             return lambda msg: getattr(lg, name)('[{}] {}'.format(nm, msg))
                                    
+    def report(self, latency=None, ok=True, chilled=False):
+        '''Tells the controller of the farm how the request went, if there's one'''
+        c=getattr(self.f, 'controller', None)
+        if c: c.report(latency, ok, chilled)
+
     def change_proxy(self, err, status=None):
         '''Change proxy, optionally changing its status. The reason might have been that it was
 bad or something, put it to the end of the list or mark as disabled.
@@ -85,53 +151,94 @@ bad or something, put it to the end of the list or mark as disabled.
         self.p=None # Will pick new proxy on next download
 
     async def cached(self, fn, what, *args, **kwargs):
-        '''Expects do_filter and cache members'''
-        try:
-            has_cache=self.cache
-        except AttributeError:
-            has_cache=False # By default
-
-        try:
-            with suppress(AttributeError): # If we don't have do_filter
-                if self.do_filter: raise FileNotFoundError
-                
-            if has_cache:
-                # Only create intermediate dirs if we use cache
-                makedirs(path.dirname(fn), exist_ok=True)
-                with open(fn, 'rb') as ff: text=ff.read()
-            else:
-                raise FileNotFoundError # Fire artificially to retrieve the page
+        '''Expects do_filter and cache members. cache can be a pagecache or aiocache (see retr.cache) to keep the pages in, fn is the key then. Otherwise if cache is true, pages are kept in the files named fn. The disk is never touched from the event loop.
+Returns the bytes found in the cache and None, or the text retrieved and the response.'''
+        store=None
+        with suppress(AttributeError): # If we don't have do_filter or cache
+            if not self.do_filter and self.cache:
+                store=cache_front(self.cache, getattr(self.f, 'fronts', aiocaches))
+        data=await store.get(fn) if store else None
+        if data is not None:
             self.debug('Found {}: {}'.format(what, fn))
-            r=None
-        except:
-            self.debug('Getting {}'.format(what))
-            r=await self.request(*args, **kwargs)
-            text=await r.text()
-            if has_cache:
-                with open(fn, 'w') as ff: ff.write(text)
-        
+            return data, None
+
+        self.debug('Getting {}'.format(what))
+        r=await self.request(*args, **kwargs)
+        text=await r.text()
+        if store: await store.put(fn, text.encode('utf8'))
         return text, r
 
-    async def pick_proxy(self, regular=False):
+    async def cached_file(self, fn, what, *args, chunk_size=1<<16, **kwargs):
+        '''Like cached(), but the body is streamed right into the file fn, it's never held in memory. Returns (fn, cached). kwargs go to stream(), so peek and max_size can be set. The file operations are run in the default executor.'''
+        run=get_running_loop().run_in_executor
+        with suppress(AttributeError): # If we don't have do_filter or cache
+            if not self.do_filter and self.cache and \
+               await run(None, path.exists, fn):
+                self.debug('Found {}: {}'.format(what, fn))
+                return fn, True
+
+        self.debug('Getting {}'.format(what))
+        await run(None, lambda: makedirs(path.dirname(fn), exist_ok=True))
+        # Under another name until it's complete
+        ff=await run(None, open, fn+'.part', 'wb')
+        try:
+            try:
+                async for chunk in self.stream(*args, chunk_size=chunk_size,
+                                               **kwargs):
+                    await run(None, ff.write, chunk)
+            finally:
+                await run(None, ff.close)
+        except BaseException:
+            # Don't leave the partial body behind. Not in the executor: we may
+            # be cancelled, and it's quick
+            with suppress(FileNotFoundError): remove(fn+'.part')
+            raise
+        await run(None, replace, fn+'.part', fn)
+        return fn, False
+
+    async def stream(self, what, url, chunk_size=1<<16, peek=0, max_size=None,
+                     **params):
+        '''Async generator of the response body chunks, the arguments are the same as in request(). The body is not held in memory.
+
+peek: that many first bytes of the body are read before validate() is called, which finds them in r.head.
+max_size: BodyTooLargeException is raised if the body turns out to be bigger.
+
+Proxy errors while the body is being read are not retried, it's too late.'''
+        r=await self.request(what, url, peek=peek, **params)
+        try:
+            if max_size and (r.content_length or 0) > max_size:
+                raise BodyTooLargeException(url)
+            head=getattr(r, 'head', b'')
+            size=len(head)
+            if head: yield head
+            async for chunk in r.content.iter_chunked(chunk_size):
+                size+=len(chunk)
+                if max_size and size > max_size:
+                    raise BodyTooLargeException(url)
+                yield chunk
+        finally:
+            r.release()
+
+    async def pick_proxy(self, regular=False, domain=None):
         '''Pick proxy manually, may be needed for cases like visa, where we need to know
         our IP to put into the requests.
-
+domain is passed to the proxypool to pick the proxy by its stats, if it does scoring.
         '''
 
         if self.p is not None: return
         
-        self.p=self.pp.get_proxy()
+        # Waits for chilling ones
+        self.p=await self.pp.get_proxy_async(domain=domain)
         self.debug("proxy: {}".format(self.p))
         
-        # I don't know what's underneath, probably connection pools and
-        # stuff. So remove previous session and make a totally new one to be
-        # safe.
+        # Make a new session to start with a clean cookie jar for the
+        # proxy. The connections are kept in the shared connector.
         if self.s:
-            self.s.close()
-            #set_trace()
-            del self.s
+            await self.s.close()
         headers=self.headers() if callable(self.headers) else self.headers
-        self.s = ClientSession(headers=headers) # loop=loop
+        self.s = ClientSession(
+            headers=headers, connector=self.connector or shared_connector(),
+            connector_owner=False)
         if regular: await self.setup_session()
 
     # def clear_cookies(self):
@@ -146,7 +253,7 @@ example, requiring authorisation at the proxy, or telling we're over the limit.
 This function validates the page, for example, looking for anchors. Basic
 function checks only for status code. To signal some unusual condition, raise a ValidateException (see the doc)
 This function may be superseded in the descendant.
-r here is aiohttp Response object.
+r here is aiohttp Response object. If the request has peek set, the beginning of the body is in r.head (see stream()).
 
         '''
         if r.status in [200, 301]: return
@@ -157,30 +264,34 @@ r here is aiohttp Response object.
     #     '''To be implemented in the descendant class. Call it to update the prepared request used within the request() cycle. For example setup_session may return some token to be used in subsequent calls'''
     #     pass
 
-    def update_stats(self, host, start, end):
-        # Get stats for the given proxy
-        if host not in self.p.stats:
-            self.p.stats[host]=proxy_stats()
-        stats=self.p.stats[host]
-        stats.latencies.append(end-start)
-        stats.last_access=start
-        print(stats)        
+    def update_stats(self, host, start, end=None, chilled=False):
+        '''Updates the stats for the current proxy and the farm's controller, end is None on failure'''
+        if end is None:
+            self.pp.record(self.p, host, start, ok=False)
+            self.report(ok=False, chilled=chilled)
+        else:
+            self.pp.record(self.p, host, start, end-start)
+            self.report(end-start)
         
-    async def request(self, what, url, regular=True, **params):
+    async def request(self, what, url, regular=True, peek=0, **params):
         '''Downloads individual URL, the signature is more or less the same as in ClientSession.request(). It manages proxies within the proxypool depending on the request outcome.
 
 Setting regular to False is used in setup_session (to evade calling setup_session() ad inf., and for other things that differ)
 
+peek set reads that many first bytes of the body to r.head before validate(), they're not in r.content anymore. Used by stream().
         '''
         r = None
         status=None # Status to set should we change proxy
 
         headers={}
         with suppress(KeyError): headers=params.pop('headers')
+        host=urlsplit(url).hostname # For the proxy stats
 
         while True:
+            start=time()
+            chilled=False # Told to chill out
             try:
-                await self.pick_proxy(regular) # This will call setup_session()
+                await self.pick_proxy(regular, host) # This will call setup_session()
 
                 #self.info( 'Before request: {} {}'.format(what, url) )
 
@@ -195,12 +306,25 @@ Setting regular to False is used in setup_session (to evade calling setup_sessio
                 if headers:
                     pass_params['headers']=headers
                     
-                with timeout(self.timeout):
+                # Politeness, if the proxypool has rate limits for the host
+                while True:
+                    delay=self.pp.throttle(self.p, host)
+                    if not delay: break
+                    await sleep(delay)
+
+                start=time() # Without setup_session()
+                async with timeout(self.timeout):
                     r = await self.s.request(what, url, **pass_params)
                 #self.info( 'After request1: {} {}'.format(what, url) )
+                if peek:
+                    try:
+                        r.head=await r.content.readexactly(peek)
+                    except IncompleteReadError as e: # The body is shorter
+                        r.head=e.partial
                 await self.validate(r) # May require getting data
 
                 self.pp.set_status( self.p, 'P' ) # Mark proxy as working
+                self.update_stats(host, start, time())
 
                 return r
             except ClientProxyConnectionError as e:
@@ -214,6 +338,7 @@ Setting regular to False is used in setup_session (to evade calling setup_sessio
                 tp, err, *rest=e.args
                 if tp == 'continue': # args=(msg,time_to_sleep)
                     self.warning(err)
+                    chilled=True
                     await sleep(rest[0])
                 elif tp == 'retry':
                     pass # Fall to the bottom to change proxy and retry
@@ -247,6 +372,7 @@ Setting regular to False is used in setup_session (to evade calling setup_sessio
                 #set_trace()
                 raise ProxyException(self.p.p)
 
+            self.update_stats(host, start, chilled=chilled)
             self.change_proxy(err, status)
 
             #self.info( 'After request2: {} {}'.format(what, url) )
@@ -0,0 +1,74 @@
+'''Priorities and deadlines of the farm items.
+
+The items go by priority (lower first), then by deadline (earlier first), then
+in the order they came. Wrap an input item in scheduled() to give it a priority
+or a deadline (in time() seconds), extend() of the farms takes them as
+arguments. The items past their deadline when their turn comes are dropped and
+counted.
+'''
+
+from heapq import heappush, heappop
+from itertools import count
+from time import time
+from logging import getLogger
+
+lg=getLogger(__name__)
+
+inf=float('inf')
+
+class scheduled:
+    '''An item with its priority and deadline'''
+    __slots__=('item', 'priority', 'deadline')
+
+    def __init__(self, item, priority=0, deadline=None):
+        self.item=item
+        self.priority=priority
+        self.deadline=deadline
+
+    def __repr__(self):
+        return 'scheduled({!r}, {}, {})'.format(self.item, self.priority,
+                                                self.deadline)
+
+def entry(i, priority, deadline, seq):
+    '''The entry to sort by, i can be scheduled()'''
+    if isinstance(i, scheduled):
+        i, priority, deadline=i.item, i.priority, i.deadline
+    return (priority, inf if deadline is None else deadline, seq, i)
+
+class itemqueue:
+    '''Heap of the entries (priority, deadline, seq, item). Not thread-safe.'''
+    def __init__(self, it=()):
+        self.heap=[]
+        self.seq=count()
+        self.expired=0 # Dropped past their deadline
+        for i in it: self.push(i)
+
+    def push(self, i, priority=0, deadline=None):
+        heappush(self.heap, entry(i, priority, deadline, next(self.seq)))
+
+    def push_entry(self, e):
+        '''Puts back an entry taken with take()'''
+        heappush(self.heap, e)
+
+    def expire(self, e, now):
+        '''Whether the entry is past its deadline, counting it'''
+        if e[1] >= now: return False
+        self.expired+=1
+        lg.warning('Past the deadline: {}'.format(e[3]))
+        return True
+
+    def take(self, n):
+        '''Up to n entries from the top, the expired are dropped'''
+        res=[]
+        now=time()
+        while self.heap and len(res) < n:
+            e=heappop(self.heap)
+            if not self.expire(e, now): res.append(e)
+        return res
+
+    def items(self):
+        '''The items in their order'''
+        return [e[3] for e in sorted(self.heap)]
+
+    def __len__(self):
+        return len(self.heap)
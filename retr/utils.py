@@ -1,5 +1,5 @@
 from logging import LoggerAdapter
-from asyncio import Task
+from asyncio import current_task
 
 class CustomAdapter(LoggerAdapter):
     '''Print a footprint of task_id before the message to aid in debugging'''
@@ -7,5 +7,9 @@ class CustomAdapter(LoggerAdapter):
     def process(self, msg, kwargs):
         # if 'extra' not in kwargs:
         #     kwargs['extra']={}
-        # kwargs['extra']['connid']=id(Task.current_task())%(1<<32)
-        return '[{:04x}] {}'.format(id(Task.current_task())%(1<<16), msg), kwargs
+        # kwargs['extra']['connid']=id(current_task())%(1<<32)
+        try:
+            task=current_task()
+        except RuntimeError: # Not in the loop
+            task=None
+        return '[{:04x}] {}'.format(id(task)%(1<<16), msg), kwargs
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+'''Compares get_proxy() of the proxypool with the OrderedDict scan it used to
+do: pop proxies one by one from the working list, discarding disabled and
+sleeping ones, and copy the whole master list when the working list runs dry.
+
+python -m samples.bench_proxypool [total] [disabled share] [calls]
+'''
+
+from sys import argv
+from time import perf_counter, time
+from collections import OrderedDict
+from logging import basicConfig, WARNING
+
+from retr.proxypool_common import proxypool, proxy
+
+basicConfig(level=WARNING)
+
+class legacy_pool:
+    '''The scan get_proxy() was based on, only the parts that matter here'''
+    def __init__(self, master_plist):
+        self.master_plist=master_plist
+        self.plist=OrderedDict()
+
+    def get_proxy(self):
+        while True:
+            try:
+                dummy,p=self.plist.popitem(False)
+                if 'D' in p.flags or 'B' in p.flags: continue
+                if 'C' in p.flags:
+                    if p.wake_time and time() >= p.wake_time:
+                        p.wake_time=None
+                        p.change_flags('', 'C')
+                        return p
+                    continue
+                return p
+            except KeyError:
+                if not any(filter(lambda v: 'D' not in v.flags,
+                                  self.master_plist.values())):
+                    raise
+                self.plist=self.master_plist.copy()
+
+    def set_status(self, p):
+        self.master_plist.move_to_end(p.p)
+        p.tries+=1
+
+def make_proxies(total, disabled):
+    res=[]
+    for i in range(total):
+        p=proxy('10.{}.{}.{}:3128'.format(i>>16, (i>>8)&255, i&255),
+                'D' if i%100 < disabled*100 else 'G')
+        res.append(p)
+    return res
+
+def bench(name, get, downvote, calls):
+    start=perf_counter()
+    for _ in range(calls):
+        downvote(get())
+    elapsed=perf_counter()-start
+    print('{:8s} {:8d} calls {:8.3f}s {:8.2f}us/call'.format(
+        name, calls, elapsed, elapsed/calls*1e6))
+
+if __name__ == '__main__':
+    total=int(argv[1]) if len(argv) > 1 else 50000
+    disabled=float(argv[2]) if len(argv) > 2 else .9
+    calls=int(argv[3]) if len(argv) > 3 else 20000
+
+    print('{} proxies, {:.0%} disabled'.format(total, disabled))
+
+    old=legacy_pool(OrderedDict((p.p, p) for p in make_proxies(total, disabled)))
+    bench('legacy', old.get_proxy, old.set_status, calls)
+
+    pp=proxypool([])
+    pp.master_plist=OrderedDict((p.p, p) for p in make_proxies(total, disabled))
+    pp.rebuild()
+    bench('engine', pp.get_proxy, pp.set_status, calls)
@@ -6,7 +6,7 @@
 from pdb import set_trace
 from logging import basicConfig, DEBUG, INFO, WARNING, ERROR, getLogger
 from csv import DictWriter
-from asyncio import get_event_loop, Future, CancelledError
+from asyncio import run
 from math import ceil
 from os import path #, remove, rename
 from pprint import PrettyPrinter
@@ -135,7 +135,27 @@ class newark(retriever):
             await self.f.extend(subcats) # Drill down
             return
         
-        cat=self.tree.xpath('//*[@id="breadcrumb"]//ul/li[position()=last()]/a/text()')[0]
+        canlink=self.tree.xpath('//link[@rel="canonical"]/@href')[0]
+        if canlink.startswith(self.baseurl+'/c/'): # Listing
+            total=int(self.tree.xpath('//span[@id="titleProdCount"]/text()')[0].replace(',',''))
+
+            #http://www.newark.com/c/automation-process-control/automation-signaling/audio-signal-indicator-units?pageSize=100
+            if '?pageSize=' not in q:
+                if total > 25: # Get all of them
+                    # Get all the pages
+                    await self.f.extend(
+                        q+'/prl/results/{}?pageSize=100'.format(_+1)
+                        for _ in range(ceil(total/100))
+                    )
+                    return
+
+        return text # Items are taken in parse(), in the process pool
+
+    @staticmethod
+    def parse(text):
+        '''Extracts the items from a product or listing page'''
+        tree=etree.fromstring(text, etree.HTMLParser())
+        cat=tree.xpath('//*[@id="breadcrumb"]//ul/li[position()=last()]/a/text()')[0]
         base_item={
             'Source': 'newark.com', 'Competitor': 'Newark',
             'Factory Lead Time': '', 'Currency': 'USD', 'Category': cat,
@@ -152,26 +172,26 @@ class newark(retriever):
         def strip_qty(txt): return txt.strip().replace('+','')
         def strip_price(txt): return txt.strip().replace('$','').replace(',','')
         
-        canlink=self.tree.xpath('//link[@rel="canonical"]/@href')[0]
-        if not canlink.startswith(self.baseurl+'/c/'):
+        canlink=tree.xpath('//link[@rel="canonical"]/@href')[0]
+        if not canlink.startswith(newark.baseurl+'/c/'):
             # http://www.newark.com/berker/09-4185-25-02/socket-schuko-euro-white/dp/08P2180
             base_item.update({
                 'URL': canlink,
-                'Manufacturer Part Number': self.tree.xpath(
+                'Manufacturer Part Number': tree.xpath(
                     './/dd[@itemprop="mpn"]/text()')[0].strip(),
-                'Newark Part Number': self.tree.xpath(
+                'Newark Part Number': tree.xpath(
                     './/dd[@itemprop="http://schema.org/sku"]/text()')[0].strip(),
-                'Manufacturer': self.tree.xpath(
+                'Manufacturer': tree.xpath(
                     '//span[@itemprop="http://schema.org/manufacturer"]/text()')[0],
-                'Description': self.tree.xpath(
+                'Description': tree.xpath(
                     '//span[@itemprop="name"]/text()')[0],
-                'Stock Value': self.tree.xpath(
+                'Stock Value': tree.xpath(
                     '//div[@class="avalabilityContainer"]/p/text()')[0].strip(),
                 'Availability': get_avail(
-                    self.tree.xpath('//div[@class="avalabilityContainer"]')[0])
+                    tree.xpath('//div[@class="avalabilityContainer"]')[0])
             })
             
-            for num, price in enumerate(self.tree.xpath('//table[@class="tableProductDetailPrice pricing threeCol"]/tbody/tr')):
+            for num, price in enumerate(tree.xpath('//table[@class="tableProductDetailPrice pricing threeCol"]/tbody/tr')):
                 #set_trace()
                 base_item.update({ # Two spans here
                     'Quantity'+str(num+1): strip_qty(price[0].text),
@@ -181,22 +201,10 @@ class newark(retriever):
             #ppr.pprint(base_item)
             return [base_item]
         
-        total=int(self.tree.xpath('//span[@id="titleProdCount"]/text()')[0].replace(',',''))
-            
-        #http://www.newark.com/c/automation-process-control/automation-signaling/audio-signal-indicator-units?pageSize=100
-        if '?pageSize=' not in q:
-            if total > 25: # Get all of them
-                # Get all the pages
-                await self.f.extend(
-                    q+'/prl/results/{}?pageSize=100'.format(_+1)
-                    for _ in range(ceil(total/100))
-                )
-                return
-
         #return
         # Now get the items
         results=[]
-        for item in self.tree.xpath('//table[@id="sProdList"]/tbody/tr'):
+        for item in tree.xpath('//table[@id="sProdList"]/tbody/tr'):
             it=base_item.copy()
             desc=item.xpath('td[@class="description"]/a/p/text()')[0]
             descp=desc.partition(' - ')
@@ -227,49 +235,29 @@ class newark(retriever):
             #ppr.pprint(it)
 
         return results
-        
-    def done_task(self, future):
-        #set_trace()
-        try:
-            it=future.result()
-        except CancelledError:
-            self.warning('main done_task: cancel retrieved')
-            it=None
-        except KeyboardInterrupt:
-            self.warning('main done_task: keyboard interrupt retrieved')
-            it=None
-        except ProxyException as e:
-            it=('B', e.args[0])
-
-        if not it: return
-        
-        self.debug('done_task: {}'.format(len(it)))
-        wr.writerows(it)
-        #for res in it: self.info(ppr.pformat(res))
 
 if 0:
     toget=['http://www.newark.com/c/electrical']
     #toget=['http://www.newark.com/c/electrical/switches-socket-outlets']
 else:
     toget=[newark.baseurl+'/browse-for-products']
-loop=get_event_loop()
 
-f=farm(toget, newark, num_tasks)
+async def main():
+    f=farm(newark, num_tasks)
 
-with open(output_fn, 'w', newline='') as fo:
-    wr=DictWriter(fo, fieldnames=out_fieldnames)
-    wr.writeheader()
-    try:
-        loop.run_forever()
-        args=[] # All done
-    except KeyboardInterrupt:
-        lg.info('Caught interrupt')
-        future = Future()
-        results, args=f.stopall(loop)
-        print(len(results), len(args))
-        #print(results[:10])
+    with open(output_fn, 'w', newline='') as fo:
+        wr=DictWriter(fo, fieldnames=out_fieldnames)
+        wr.writeheader()
+        try:
+            async for it in f.run(toget):
+                lg.debug('Got {}'.format(len(it)))
+                wr.writerows(it)
+        finally:
+            if f.remaining: lg.info('Unprocessed: {}'.format(len(f.remaining)))
+
+try:
+    run(main())
+except KeyboardInterrupt:
+    lg.info('Caught interrupt')
 
-fo.close()
-f.close()
-            
 pp.write()
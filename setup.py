@@ -9,8 +9,8 @@ CLASSIFIERS = [
     'Intended Audience :: Developers',
     'License :: OSI Approved :: GNU General Public License v3 or later (GPLv3+)',
     'Operating System :: OS Independent',
-    'Programming Language :: Python :: 3.4',
-    'Programming Language :: Python :: 3.5',
+    'Programming Language :: Python :: 3.10',
+    'Programming Language :: Python :: 3.11',
     'Topic :: Software Development :: Libraries :: Python Modules',
     'Topic :: Internet :: WWW/HTTP :: Dynamic Content',
 ]
@@ -31,7 +31,8 @@ setup(
     #zip_safe=False,
     install_requires=[
         'requests>=2.0', # For the legacy (threaded) version
-        'aiohttp>=2.0.6', # For the new version
+        'aiohttp>=3.8', # For the new version
+        'async_timeout; python_version < "3.11"',
         'retrying'
     ]
 )
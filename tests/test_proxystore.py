@@ -0,0 +1,38 @@
+from retr.proxypool import proxypool
+from retr.proxystore import proxystore
+from retr.proxypool_common import proxy_stats
+
+def test_empty_db(tmp_path):
+    fn=str(tmp_path/'proxies.db')
+    pp=proxypool(fn)
+    assert len(pp.master_plist) == 0
+    pp.write()
+    assert len(proxystore(fn)) == 0 # Still SQLite, not overwritten with TSV
+
+def test_empty_store(tmp_path):
+    st=proxystore(str(tmp_path/'proxies.db'))
+    pp=proxypool(st)
+    assert pp.store is st
+    assert len(pp.master_plist) == 0
+
+def test_save_and_load(tmp_path):
+    fn=str(tmp_path/'proxies.db')
+    st=proxystore(fn)
+    st.import_tsv(write_tsv(tmp_path, 'http://1.1.1.1:80\tG\nhttp://2.2.2.2:80\n'))
+    pp=proxypool(fn)
+    assert list(pp.master_plist) == ['http://1.1.1.1:80', 'http://2.2.2.2:80']
+    p=pp.master_plist['http://2.2.2.2:80']
+    p.stats['example.com']=proxy_stats()
+    p.stats['example.com'].update(0, .5)
+    p.change_flags('P', '')
+    pp.dirty.add(p.p)
+    pp.write()
+    assert not pp.dirty
+    loaded={_.p: _ for _ in proxystore(fn).load()}
+    assert list(loaded)[0] == 'http://2.2.2.2:80' # Proven first
+    assert loaded['http://2.2.2.2:80'].stats['example.com'].latency == .5
+
+def write_tsv(tmp_path, text):
+    fn=tmp_path/'proxies.tsv'
+    fn.write_text(text)
+    return str(fn)